@@ -0,0 +1,86 @@
+import threading
+import time
+
+# Reusing clients lets their connections be shared by every thread of a script, so size the pool for that.
+MAX_POOL_CONNECTIONS = 50
+
+session = None
+clients = {}
+clients_lock = threading.Lock()
+
+
+def get_session():
+    """ Shared boto3 session, created on first use. """
+    
+    with clients_lock:
+        return _get_session()
+
+
+def _get_session():
+    
+    global session
+    
+    if session is None:
+        
+        # boto3 and botocore take a large share of the runtime of a short script to import, so it is only done once a
+        # client is actually needed, and never for --help.
+        import boto3
+        
+        session = boto3.session.Session()
+    
+    return session
+
+
+def get_client(service_name: str, region_name: str = None):
+    """ Shared client of a service in a region, created on first use.
+    
+    Building a client loads and parses the botocore service model and resolves credentials, so every script asking
+    for the same service and region gets the same client. Clients are safe to use from several threads. """
+    
+    key = (service_name, region_name)
+    
+    client = clients.get(key)
+    if client is not None:
+        
+        return client
+    
+    with clients_lock:
+        
+        if key not in clients:
+            
+            from botocore.config import Config
+            
+            clients[key] = _get_session().client(service_name, region_name=region_name,
+                                                 config=Config(max_pool_connections=MAX_POOL_CONNECTIONS))
+        
+        return clients[key]
+
+
+class RateLimiter:
+    """ Token bucket spacing out calls to at most rate per second, shared by every thread using it. """
+    
+    def __init__(self, rate: float, burst: int = 1):
+        
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+    
+    def acquire(self):
+        """ Take a token, sleeping until one is available. """
+        
+        with self.lock:
+            
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            
+            if self.tokens < 1:
+                
+                time.sleep((1 - self.tokens) / self.rate)
+                
+                self.tokens = 1
+                self.updated = time.monotonic()
+            
+            self.tokens -= 1
\ No newline at end of file
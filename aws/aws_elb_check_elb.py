@@ -1,6 +1,36 @@
 import argparse
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 import requests
 import dns.resolver
+from requests.adapters import HTTPAdapter
+
+
+def get_session(pool_size: int):
+    """ Session shared by every probe, with a connection pool large enough for all of them to run at once. """
+
+    session = requests.Session()
+
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    return session
+
+
+def probe(session: requests.Session, url: str, timeout: tuple):
+    """ Status code of a GET on url, or the error if there was no response, and the seconds it took. """
+
+    start_time = time.monotonic()
+
+    try:
+        status = session.get(url, timeout=timeout).status_code
+    except requests.RequestException as e:
+        status = 'XXX ' + type(e).__name__
+
+    return status, time.monotonic() - start_time
 
 
 if __name__ == '__main__':
@@ -9,20 +39,45 @@ if __name__ == '__main__':
     parser.add_argument('--elb_name', required=True, help='Value of ELB DNS.')
     parser.add_argument('--path', required=True,
                         help='Path to test for HTTP status code 200.')
+    parser.add_argument('--workers', type=int, default=32, help='Number of nodes probed at once.')
+    parser.add_argument('--connect_timeout', type=float, default=3, help='Seconds to wait for a node to connect.')
+    parser.add_argument('--read_timeout', type=float, default=10, help='Seconds to wait for a node to respond.')
 
     args = parser.parse_args()
 
     url = 'all.' + args.elb_name
 
     answers = dns.resolver.query(url, 'A')
-    count = 1
+
+    test_requests = []
     for ip in answers:
 
         ip = str(ip)
-        test_request = 'http://' + ip + '/' + args.path
+        test_requests.append('http://' + ip + '/' + args.path)
+
+    session = get_session(args.workers)
+
+    # Nodes are probed concurrently, so a check takes about as long as the slowest node, and a hung node only
+    # holds up the check until it times out.
+    failed = 0
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+
+        results = executor.map(lambda test_request: probe(session, test_request,
+                                                          (args.connect_timeout, args.read_timeout)), test_requests)
+
+        count = 1
+        for test_request, (status, latency) in zip(test_requests, results):
+
+            print(str(count) + '. ' + test_request + ' > ' + str(status) + ' in ' + str(round(latency * 1000)) + ' ms')
+
+            if status != 200:
+
+                failed += 1
+
+            count += 1
 
-        request = requests.get(test_request)
+    if failed:
 
-        print(str(count) + '. ' + test_request + ' > ' + str(request.status_code))
+        print('XXX %s of %s nodes did not return 200.' % (failed, len(test_requests)))
 
-        count += 1
+        sys.exit(1)
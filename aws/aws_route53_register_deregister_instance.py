@@ -1,11 +1,22 @@
-import boto3
-import requests
 import argparse
+import fcntl
+import glob
+import json
+import os
+import random
+import re
 import socket
 import struct
 import sys
+import time
 from time import sleep
 
+from aws_clients import RateLimiter, get_client
+
+
+# Route 53 allows 5 API requests per second per account, and throttles every caller of the account beyond that.
+route53_rate_limiter = RateLimiter(5)
+
 
 def add_entry(this_ip: str, hosted_zone_id: str, record_bucket: int, record_set_name: str, record_type: str,
               record_ttl: str, ip_list: list):
@@ -13,12 +24,13 @@ def add_entry(this_ip: str, hosted_zone_id: str, record_bucket: int, record_set_
     
     response = ''
     
-    route53_client = boto3.client('route53')
+    route53_client = get_client('route53')
     
     counter = 1
     while counter <= 25:
         
         try:
+            route53_rate_limiter.acquire()
             response = route53_client.change_resource_record_sets(
                     HostedZoneId=hosted_zone_id,
                     ChangeBatch={
@@ -40,6 +52,8 @@ def add_entry(this_ip: str, hosted_zone_id: str, record_bucket: int, record_set_
                     }
             )
             
+            invalidate_record_index(hosted_zone_id)
+            
             print(this_ip + ' >>> IP insert complete.')
             
             break
@@ -62,12 +76,13 @@ def remove_entry(this_ip: str, hosted_zone_id: str, record_bucket: int, record_s
     
     response = ''
     
-    route53_client = boto3.client('route53')
+    route53_client = get_client('route53')
     
     counter = 1
     while counter <= 25:
         
         try:
+            route53_rate_limiter.acquire()
             response = route53_client.change_resource_record_sets(
                     HostedZoneId=hosted_zone_id,
                     ChangeBatch={
@@ -89,6 +104,8 @@ def remove_entry(this_ip: str, hosted_zone_id: str, record_bucket: int, record_s
                     }
             )
             
+            invalidate_record_index(hosted_zone_id)
+            
             print(this_ip + ' >>> IP delete complete.')
             
             break
@@ -112,42 +129,125 @@ def get_ip_bucket(ip):
     return struct.unpack("!L", packed_ip)[0] % 100
 
 
-def get_ips_for_bucket(hosted_zone_id, record_name, bucket):
-    response = ''
+# Record sets listed from Route 53 are reused for this long, so looking up several buckets of one record name costs a
+# single listing. Every change this script makes drops the cached record sets of its hosted zone.
+RECORD_INDEX_TTL_SECONDS = 10
+
+record_index_cache = {}
+
+
+def get_record_name_key(record_name: str):
+    """ Record name as Route 53 compares it, without the trailing dot and case-insensitive.
     
-    route53_client = boto3.client('route53')
+    Route 53 returns special characters octal escaped, such as \\052 for a wildcard, so escapes are decoded first. """
     
-    counter = 1
-    while counter <= 25:
+    record_name = re.sub(r'\\([0-7]{3})', lambda match: chr(int(match.group(1), 8)), record_name)
+    
+    return record_name.lower().rstrip('.')
+
+
+def list_record_sets(hosted_zone_id: str, record_name: str, record_type: str = None):
+    """ List the record sets of one name, and type if given, starting where they are in the zone rather than at its
+    beginning, and following pages only while they still hold that name. """
+    
+    route53_client = get_client('route53')
+    
+    params = {'HostedZoneId': hosted_zone_id, 'StartRecordName': record_name}
+    if record_type:
         
-        try:
-            response = route53_client.list_resource_record_sets(
-                    HostedZoneId=hosted_zone_id
-            )
+        params['StartRecordType'] = record_type
+    
+    record_sets = []
+    while True:
+        
+        response = None
+        
+        counter = 1
+        while counter <= 25:
             
-            break
+            try:
+                route53_rate_limiter.acquire()
+                response = route53_client.list_resource_record_sets(**params)
+                
+                break
+            
+            except Exception as e:
+                
+                sleepy_time = counter ** 2
+                print('Exception trying to get list of records for bucket.')
+                print('XXX Exception: %s' % str(e.args))
+                print('XXX Iteration %s, sleeping for %s seconds.' % (str(counter), str(sleepy_time)))
+                sleep(sleepy_time)
+            
+            counter += 1
         
-        except Exception as e:
+        if response is None:
             
-            sleepy_time = counter ** 2
-            print('Exception trying to get list of records for bucket.')
-            print('XXX Exception: %s' % str(e.args))
-            print('XXX Iteration %s, sleeping for %s seconds.' % (str(counter), str(sleepy_time)))
-            sleep(sleepy_time)
+            raise Exception('Giving up listing record sets of %s.' % record_name)
         
-        counter += 1
+        for record_set in response['ResourceRecordSets']:
+            
+            # Record sets are sorted by name and type, so the first other one means there are no more.
+            if get_record_name_key(record_set['Name']) != get_record_name_key(record_name) or (
+                    record_type and record_set['Type'] != record_type):
+                
+                return record_sets
+            
+            record_sets.append(record_set)
+        
+        if not response['IsTruncated']:
+            
+            return record_sets
+        
+        params['StartRecordName'] = response['NextRecordName']
+        params['StartRecordType'] = response['NextRecordType']
+        
+        if 'NextRecordIdentifier' in response:
+            
+            params['StartRecordIdentifier'] = response['NextRecordIdentifier']
+        else:
+            
+            params.pop('StartRecordIdentifier', None)
+
+
+def get_record_index(hosted_zone_id: str, record_name: str, record_type: str = None):
+    """ IPs per (record name, set identifier) of one record name, cached for RECORD_INDEX_TTL_SECONDS. """
+    
+    cache_key = (hosted_zone_id, get_record_name_key(record_name), record_type)
+    
+    if cache_key in record_index_cache and record_index_cache[cache_key][0] > time.monotonic():
+        
+        return record_index_cache[cache_key][1]
+    
+    record_index = {}
+    for record_set in list_record_sets(hosted_zone_id, record_name, record_type):
+        
+        if 'SetIdentifier' in record_set:
+            
+            record_index[(get_record_name_key(record_set['Name']), record_set['SetIdentifier'])] = [
+                resource_record['Value'] for resource_record in record_set.get('ResourceRecords', [])]
     
-    response = response['ResourceRecordSets']
+    record_index_cache[cache_key] = (time.monotonic() + RECORD_INDEX_TTL_SECONDS, record_index)
     
-    ip_list = []
-    for response_item in response:
+    return record_index
+
+
+def invalidate_record_index(hosted_zone_id: str):
+    """ Drop the cached record sets of a hosted zone after changing it. """
+    
+    for cache_key in list(record_index_cache):
         
-        if 'SetIdentifier' in response_item and response_item['SetIdentifier'] == record_name + '_' + str(bucket):
+        if cache_key[0] == hosted_zone_id:
             
-            for resource_records in response_item['ResourceRecords']:
-                ip_list.append(resource_records['Value'])
+            del record_index_cache[cache_key]
+
+
+def get_ips_for_bucket(hosted_zone_id, record_name, bucket, record_type: str = None):
+    """ IPs in the record set of one bucket. """
+    
+    record_index = get_record_index(hosted_zone_id, record_name, record_type)
     
-    return ip_list
+    return list(record_index.get((get_record_name_key(record_name), record_name + '_' + str(bucket)), []))
 
 
 def get_value_string_from_ips(ip_list: list):
@@ -161,6 +261,415 @@ def get_value_string_from_ips(ip_list: list):
     return ip_string
 
 
+# Route 53 accepts at most 1000 resource records per change batch, and counts the values of an UPSERT twice.
+MAX_CHANGE_BATCH_RECORDS = 1000
+
+
+def get_record_change(action: str, record_set_name: str, record_type: str, record_ttl: int, record_bucket: int,
+                      ip_list: list):
+    """ Change of the weighted record set of one bucket, as used in a change batch. """
+    
+    return {
+        'Action'           : action,
+        'ResourceRecordSet': {
+            'Name'           : record_set_name,
+            'Type'           : record_type,
+            'TTL'            : record_ttl,
+            'ResourceRecords': get_value_string_from_ips(ip_list),
+            'Weight'         : 1,
+            'SetIdentifier'  : record_set_name + '_' + str(record_bucket)
+        }
+    }
+
+
+def get_change_batches(changes: list):
+    """ Split changes into as few change batches as Route 53 accepts. """
+    
+    change_batches = []
+    batch = []
+    batch_records = 0
+    for change in changes:
+        
+        change_records = len(change['ResourceRecordSet']['ResourceRecords'])
+        if change['Action'] == 'UPSERT':
+            
+            change_records *= 2
+        
+        if batch and batch_records + change_records > MAX_CHANGE_BATCH_RECORDS:
+            
+            change_batches.append(batch)
+            batch = []
+            batch_records = 0
+        
+        batch.append(change)
+        batch_records += change_records
+    
+    if batch:
+        
+        change_batches.append(batch)
+    
+    return change_batches
+
+
+def apply_changes(hosted_zone_id: str, changes: list):
+    """ Submit changes to a hosted zone in as few calls as possible, and return the responses. """
+    
+    responses = []
+    
+    route53_client = get_client('route53')
+    
+    for change_batch in get_change_batches(changes):
+        
+        counter = 1
+        while counter <= 25:
+            
+            try:
+                route53_rate_limiter.acquire()
+                responses.append(route53_client.change_resource_record_sets(
+                        HostedZoneId=hosted_zone_id,
+                        ChangeBatch={
+                            'Comment': 'Coalesced registration of %s record sets.' % len(change_batch),
+                            'Changes': change_batch
+                        }
+                ))
+                
+                invalidate_record_index(hosted_zone_id)
+                
+                print('>>> Applied %s changes to hosted zone %s.' % (len(change_batch), hosted_zone_id))
+                
+                break
+            
+            except Exception as e:
+                
+                sleepy_time = counter ** 2
+                print('XXX Exception: %s' % str(e.args))
+                print('XXX Iteration %s, sleeping for %s seconds.' % (str(counter), str(sleepy_time)))
+                sleep(sleepy_time)
+            
+            counter += 1
+        
+        else:
+            
+            raise Exception('Giving up on %s changes to hosted zone %s.' % (len(change_batch), hosted_zone_id))
+    
+    return responses
+
+
+def merge_intents(intents: list):
+    """ Final IPs of every bucket touched by a list of add and remove intents, applied in order on top of the IPs
+    currently in Route 53. """
+    
+    buckets = {}
+    for intent in intents:
+        
+        ip_bucket = get_ip_bucket(intent['ip'])
+        key = (intent['hosted_zone_id'], intent['record_name'], intent['record_type'], ip_bucket)
+        
+        if key not in buckets:
+            
+            current_ips = get_ips_for_bucket(intent['hosted_zone_id'], intent['record_name'], ip_bucket,
+                                             intent['record_type'])
+            buckets[key] = {'current_ips': current_ips, 'ips': list(current_ips)}
+        
+        bucket = buckets[key]
+        bucket['record_ttl'] = intent['record_ttl']
+        
+        if intent['action'] == 'add' and intent['ip'] not in bucket['ips']:
+            
+            bucket['ips'].append(intent['ip'])
+        
+        elif intent['action'] == 'remove' and intent['ip'] in bucket['ips']:
+            
+            bucket['ips'].remove(intent['ip'])
+    
+    return buckets
+
+
+def get_bucket_changes(buckets: dict):
+    """ Changes per hosted zone that take every bucket from its current IPs to its final IPs. A bucket left empty is
+    deleted, unchanged buckets are left out. """
+    
+    changes = {}
+    for (hosted_zone_id, record_name, record_type, ip_bucket), bucket in sorted(buckets.items()):
+        
+        if sorted(bucket['ips']) == sorted(bucket['current_ips']):
+            
+            continue
+        
+        if bucket['ips']:
+            
+            change = get_record_change('UPSERT', record_name, record_type, bucket['record_ttl'], ip_bucket,
+                                       bucket['ips'])
+        else:
+            
+            change = get_record_change('DELETE', record_name, record_type, bucket['record_ttl'], ip_bucket,
+                                       bucket['current_ips'])
+        
+        changes.setdefault(hosted_zone_id, []).append(change)
+    
+    return changes
+
+
+def apply_intents(intents: list):
+    """ Merge add and remove intents per bucket and apply them with one change batch per hosted zone. """
+    
+    responses = []
+    
+    for hosted_zone_id, changes in get_bucket_changes(merge_intents(intents)).items():
+        
+        responses += apply_changes(hosted_zone_id, changes)
+    
+    return responses
+
+
+def enqueue_intent(queue_directory: str, intent: dict):
+    """ Atomically add an intent to the queue directory, and return its path. """
+    
+    os.makedirs(queue_directory, exist_ok=True)
+    
+    # Intents are applied in the order of their file names, so the name starts with the time they were queued.
+    path = os.path.join(queue_directory, '%019d_%s_%s.intent' % (time.time_ns(), intent['ip'], os.getpid()))
+    
+    with open(path + '.tmp', 'w') as handler:
+        json.dump(intent, handler)
+    
+    os.replace(path + '.tmp', path)
+    
+    return path
+
+
+def process_intent_queue(queue_directory: str, coalesce_seconds: float):
+    """ Apply queued intents until the queue is empty. Only the instance holding the queue lock may call this.
+    
+    The changes applying an intent are written next to it, for the instance that queued it to wait for. Intents that
+    cannot be read are set aside as .rejected, so they do not fail the intents queued with them. """
+    
+    # Instances started by the same scaling event queue their intents within moments of each other.
+    sleep(coalesce_seconds)
+    
+    # Change files nobody picked up, because the instance waiting for them died, are cleaned up after an hour.
+    for path in glob.glob(os.path.join(queue_directory, '*.intent.changes')) + \
+            glob.glob(os.path.join(queue_directory, '*.intent.rejected')):
+        
+        if os.path.getmtime(path) < time.time() - 3600:
+            
+            os.remove(path)
+    
+    while True:
+        
+        paths = sorted(glob.glob(os.path.join(queue_directory, '*.intent')))
+        
+        if not paths:
+            
+            break
+        
+        intents = []
+        intent_paths = []
+        for path in paths:
+            
+            try:
+                with open(path, 'r') as handler:
+                    intent = json.load(handler)
+                
+                get_ip_bucket(intent['ip'])
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                print('XXX Setting aside queued intent %s: %s' % (path, str(e)))
+                os.replace(path, path + '.rejected')
+                continue
+            
+            intents.append(intent)
+            intent_paths.append(path)
+        
+        if not intents:
+            
+            continue
+        
+        print('--- Applying %s queued intents.' % len(intents))
+        
+        change_infos = get_change_infos(apply_intents(intents))
+        
+        for path in intent_paths:
+            
+            with open(path + '.changes.tmp', 'w') as handler:
+                json.dump(change_infos, handler)
+            
+            os.replace(path + '.changes.tmp', path + '.changes')
+            os.remove(path)
+
+
+def wait_for_intent(queue_directory: str, path: str, coalesce_seconds: float):
+    """ Wait until a queued intent has been applied, applying the whole queue if no other instance is doing so, and
+    return the changes that applied it.
+    
+    The instance holding the lock on the queue directory is the only one changing records, so concurrent
+    registrations no longer overwrite each other. If it dies, its lock is released and another instance takes over. """
+    
+    lock_path = os.path.join(queue_directory, 'coordinator.lock')
+    
+    while os.path.exists(path):
+        
+        with open(lock_path, 'a') as lock_handler:
+            
+            try:
+                fcntl.flock(lock_handler, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                sleep(0.5)
+                continue
+            
+            try:
+                process_intent_queue(queue_directory, coalesce_seconds)
+            finally:
+                fcntl.flock(lock_handler, fcntl.LOCK_UN)
+    
+    if os.path.exists(path + '.rejected'):
+        
+        os.remove(path + '.rejected')
+        
+        raise ValueError('Queued intent %s could not be read.' % path)
+    
+    change_infos = []
+    
+    if os.path.exists(path + '.changes'):
+        
+        with open(path + '.changes', 'r') as handler:
+            change_infos = json.load(handler)
+        
+        os.remove(path + '.changes')
+    
+    return change_infos
+
+
+# get_change is polled with exponential backoff between these bounds. The jitter keeps many waiting instances from
+# polling in lockstep.
+CHANGE_POLL_MIN_SECONDS = 1
+CHANGE_POLL_MAX_SECONDS = 15
+
+
+def get_change_infos(responses: list):
+    """ [change ID, submission timestamp] of every change in change_resource_record_sets responses, once each. """
+    
+    change_infos = {}
+    for response in responses:
+        
+        if response:
+            
+            change_infos[response['ChangeInfo']['Id']] = response['ChangeInfo']['SubmittedAt'].timestamp()
+    
+    return [[change_id, submitted_at] for change_id, submitted_at in sorted(change_infos.items())]
+
+
+def wait_for_changes(change_infos: list, timeout: float):
+    """ Poll get_change until every change is INSYNC or timeout seconds have passed.
+    
+    A single loop polls all outstanding changes, each on its own capped and jittered backoff. Returns the seconds from
+    submission until each change was seen in sync, or None for changes still pending. """
+    
+    route53_client = get_client('route53')
+    
+    deadline = time.monotonic() + timeout
+    submitted_at = dict([(change_id, change_submitted_at) for change_id, change_submitted_at in change_infos])
+    polls = dict([(change_id, (0, time.monotonic())) for change_id in submitted_at])
+    
+    latencies = {}
+    while polls and time.monotonic() < deadline:
+        
+        for change_id, (attempt, next_poll) in sorted(polls.items()):
+            
+            if next_poll > time.monotonic():
+                
+                continue
+            
+            status = None
+            
+            try:
+                route53_rate_limiter.acquire()
+                status = route53_client.get_change(Id=change_id)['ChangeInfo']['Status']
+            except Exception as e:
+                print('XXX Exception polling change %s: %s' % (change_id, str(e.args)))
+            
+            if status == 'INSYNC':
+                
+                latencies[change_id] = time.time() - submitted_at[change_id]
+                del polls[change_id]
+                
+                print('>>> Change %s in sync after %.1f seconds.' % (change_id, latencies[change_id]))
+            else:
+                
+                delay = min(CHANGE_POLL_MAX_SECONDS, CHANGE_POLL_MIN_SECONDS * 2 ** attempt) * random.uniform(0.5, 1)
+                polls[change_id] = (attempt + 1, time.monotonic() + delay)
+        
+        if polls:
+            
+            next_poll = min([change_next_poll for attempt, change_next_poll in polls.values()])
+            sleep(max(min(next_poll, deadline) - time.monotonic(), 0))
+    
+    for change_id in polls:
+        
+        latencies[change_id] = None
+    
+    return latencies
+
+
+def report_propagation(change_infos: list, timeout: float):
+    """ Wait for changes to be in sync and print how long they took. Returns whether all of them are in sync. """
+    
+    latencies = wait_for_changes(change_infos, timeout)
+    in_sync_latencies = [latency for latency in latencies.values() if latency is not None]
+    
+    if in_sync_latencies:
+        
+        print('>>> %s changes in sync, propagation took %.1f seconds on average and %.1f seconds at most.' % (
+            len(in_sync_latencies), sum(in_sync_latencies) / len(in_sync_latencies), max(in_sync_latencies)))
+    
+    if len(in_sync_latencies) < len(latencies):
+        
+        print('XXX %s changes still not in sync after %s seconds.' % (
+            len(latencies) - len(in_sync_latencies), timeout))
+        
+        return False
+    
+    return True
+
+
+def read_bulk_intents(handler, default_action: str, record_name: str, record_type: str, record_ttl: int,
+                      hosted_zone_id: str):
+    """ Read intents from lines of "add <ip>", "remove <ip>" or just "<ip>" for the default action. Blank lines and
+    lines starting with # are skipped. """
+    
+    intents = []
+    for line_number, line in enumerate(handler, start=1):
+        
+        line = line.strip()
+        
+        if not line or line.startswith('#'):
+            
+            continue
+        
+        parts = line.split()
+        
+        if len(parts) == 1 and default_action:
+            
+            parts = [default_action] + parts
+        
+        if len(parts) != 2 or parts[0] not in ['add', 'remove']:
+            
+            raise ValueError('Line %s is not "add <ip>" or "remove <ip>": %s' % (line_number, line))
+        
+        # Fails on anything that is not an IPv4 address, before any record is changed.
+        get_ip_bucket(parts[1])
+        
+        intents.append({
+            'action'        : parts[0],
+            'ip'            : parts[1],
+            'hosted_zone_id': hosted_zone_id,
+            'record_name'   : record_name,
+            'record_type'   : record_type,
+            'record_ttl'    : record_ttl
+        })
+    
+    return intents
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     
@@ -170,19 +679,121 @@ if __name__ == '__main__':
     parser.add_argument('--record_ttl', required=True, type=int, help='Record TTL.')
     parser.add_argument('--hosted_zone_id', required=True,
                         help='Route 53 hosted zone ID of zone to which this entry will be added.')
-    parser.add_argument('--action', required=True, choices=['add', 'remove'],
-                        help='Whether to add or remove the entry for this machine.')
+    parser.add_argument('--action', choices=['add', 'remove'],
+                        help='Whether to add or remove the entry for this machine, or the default action of '
+                             '--bulk_file lines.')
     parser.add_argument('--testing_ip', help='IP address to use for testing.')
+    parser.add_argument('--queue_directory',
+                        help='Queue the change in this directory, local or on shared storage, and let one instance '
+                             'apply all queued changes per bucket together, instead of changing the record directly.')
+    parser.add_argument('--coalesce_seconds', type=float, default=2,
+                        help='How long the instance applying queued changes waits for more to arrive.')
+    parser.add_argument('--bulk_file',
+                        help='Add or remove many IPs at once instead of this machine. Lines of the file, or stdin '
+                             'for -, are "add <ip>", "remove <ip>", or "<ip>" for --action.')
+    parser.add_argument('--requests_per_second', type=float, default=5,
+                        help='Route 53 API requests per second this process stays under.')
+    parser.add_argument('--wait', action='store_true',
+                        help='Wait until the changes are in sync on all Route 53 name servers, and report how long '
+                             'that took.')
+    parser.add_argument('--wait_timeout', type=float, default=600,
+                        help='Seconds to wait for --wait before exiting with an error.')
     
     args = parser.parse_args()
     
+    if not args.action and not args.bulk_file:
+        
+        parser.error('--action is required unless --bulk_file is used.')
+    
+    route53_rate_limiter.rate = args.requests_per_second
+    
+    if args.bulk_file:
+        
+        start_time = time.monotonic()
+        
+        if args.bulk_file == '-':
+            
+            bulk_intents = read_bulk_intents(sys.stdin, args.action, args.record_name, args.record_type,
+                                             args.record_ttl, args.hosted_zone_id)
+        else:
+            
+            with open(args.bulk_file, 'r') as bulk_handler:
+                bulk_intents = read_bulk_intents(bulk_handler, args.action, args.record_name, args.record_type,
+                                                 args.record_ttl, args.hosted_zone_id)
+        
+        print('--- Applying %s intents for record name %s in hosted zone %s.' % (
+            len(bulk_intents), args.record_name, args.hosted_zone_id))
+        
+        bulk_change_infos = []
+        
+        if args.queue_directory:
+            
+            intent_paths = [enqueue_intent(args.queue_directory, intent) for intent in bulk_intents]
+            
+            for intent_path in intent_paths:
+                
+                bulk_change_infos += wait_for_intent(args.queue_directory, intent_path, args.coalesce_seconds)
+            
+            # Intents applied together share their changes.
+            bulk_change_infos = [list(change_info) for change_info in sorted(set(map(tuple, bulk_change_infos)))]
+        else:
+            
+            bulk_change_infos = get_change_infos(apply_intents(bulk_intents))
+        
+        print('>>> Applied %s intents in %.1f seconds.' % (len(bulk_intents), time.monotonic() - start_time))
+        
+        if args.wait and not report_propagation(bulk_change_infos, args.wait_timeout):
+            
+            sys.exit(1)
+        
+        sys.exit(0)
+    
     if args.testing_ip:
         my_ip = args.testing_ip
     else:
+        import requests
+        
         my_ip = requests.get('http://www.wgetip.com').text
     
+    # Fails on anything that is not an IPv4 address, such as an error page, before it is queued or applied.
     ip_bucket = get_ip_bucket(my_ip)
-    ips = get_ips_for_bucket(args.hosted_zone_id, args.record_name, ip_bucket)
+    
+    if args.queue_directory:
+        
+        print(my_ip + ' --- Queueing %s in hosted zone %s, record name %s.' % (
+            args.action, args.hosted_zone_id, args.record_name))
+        
+        intent_path = enqueue_intent(args.queue_directory, {
+            'action'        : args.action,
+            'ip'            : my_ip,
+            'hosted_zone_id': args.hosted_zone_id,
+            'record_name'   : args.record_name,
+            'record_type'   : args.record_type,
+            'record_ttl'    : args.record_ttl
+        })
+        
+        try:
+            intent_change_infos = wait_for_intent(args.queue_directory, intent_path, args.coalesce_seconds)
+        except Exception:
+            
+            # Do not leave an intent behind that another instance would apply long after this one gave up.
+            if os.path.exists(intent_path):
+                
+                os.remove(intent_path)
+            
+            raise
+        
+        print(my_ip + ' >>> Queued %s applied.' % args.action)
+        
+        if args.wait and not report_propagation(intent_change_infos, args.wait_timeout):
+            
+            sys.exit(1)
+        
+        sys.exit(0)
+    
+    ips = get_ips_for_bucket(args.hosted_zone_id, args.record_name, ip_bucket, args.record_type)
+    
+    response = ''
     
     already_exists = False
     if args.action == 'add':
@@ -203,10 +814,10 @@ if __name__ == '__main__':
         
         values = get_value_string_from_ips(ips)
         
-        add_entry(this_ip=my_ip, hosted_zone_id=args.hosted_zone_id, record_bucket=ip_bucket,
-                  record_set_name=args.record_name,
-                  record_type=args.record_type,
-                  record_ttl=args.record_ttl, ip_list=values)
+        response = add_entry(this_ip=my_ip, hosted_zone_id=args.hosted_zone_id, record_bucket=ip_bucket,
+                             record_set_name=args.record_name,
+                             record_type=args.record_type,
+                             record_ttl=args.record_ttl, ip_list=values)
     
     elif args.action == 'remove':
         
@@ -220,10 +831,10 @@ if __name__ == '__main__':
             
             values = get_value_string_from_ips(ips)
             
-            remove_entry(this_ip=my_ip, hosted_zone_id=args.hosted_zone_id, record_bucket=ip_bucket,
-                         record_set_name=args.record_name,
-                         record_type=args.record_type,
-                         record_ttl=args.record_ttl, ip_list=values)
+            response = remove_entry(this_ip=my_ip, hosted_zone_id=args.hosted_zone_id, record_bucket=ip_bucket,
+                                    record_set_name=args.record_name,
+                                    record_type=args.record_type,
+                                    record_ttl=args.record_ttl, ip_list=values)
         else:
             
             if my_ip in ips:
@@ -233,11 +844,15 @@ if __name__ == '__main__':
                 ips.remove(my_ip)
                 values = get_value_string_from_ips(ips)
                 
-                add_entry(this_ip=my_ip, hosted_zone_id=args.hosted_zone_id, record_bucket=ip_bucket,
-                          record_set_name=args.record_name,
-                          record_type=args.record_type,
-                          record_ttl=args.record_ttl, ip_list=values)
+                response = add_entry(this_ip=my_ip, hosted_zone_id=args.hosted_zone_id, record_bucket=ip_bucket,
+                                     record_set_name=args.record_name,
+                                     record_type=args.record_type,
+                                     record_ttl=args.record_ttl, ip_list=values)
             else:
                 print(my_ip + ' >>> IP not present in record.')
     else:
         print(my_ip + ' --- Incorrect action.')
+    
+    if args.wait and response and not report_propagation(get_change_infos([response]), args.wait_timeout):
+        
+        sys.exit(1)
\ No newline at end of file
@@ -0,0 +1,82 @@
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+import aws_clients
+
+
+def time_command(command: list, repeat: int, cwd: str = None):
+    """ Median wall time of running a command, in seconds. """
+    
+    seconds = []
+    for _ in range(repeat):
+        
+        start_time = time.perf_counter()
+        subprocess.run(command, cwd=cwd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        seconds.append(time.perf_counter() - start_time)
+    
+    return statistics.median(seconds)
+
+
+def time_calls(function, repeat: int):
+    """ Wall time of the first call and median wall time of the following calls of a function, in seconds. """
+    
+    start_time = time.perf_counter()
+    function()
+    first_seconds = time.perf_counter() - start_time
+    
+    seconds = []
+    for _ in range(repeat):
+        
+        start_time = time.perf_counter()
+        function()
+        seconds.append(time.perf_counter() - start_time)
+    
+    return first_seconds, statistics.median(seconds)
+
+
+if __name__ == '__main__':
+    
+    parser = argparse.ArgumentParser()
+    
+    parser.add_argument('--repeat', type=int, default=10, help='How often each measurement is repeated.')
+    parser.add_argument('--regions', nargs='+', default=['us-east-1', 'ap-south-1', 'ap-southeast-1'],
+                        help='Regions clients are built for.')
+    
+    args = parser.parse_args()
+    
+    script_directory = os.path.dirname(os.path.abspath(__file__))
+    
+    # Startup of the scripts, which no longer import boto3 before they need a client.
+    startup_commands = {
+        'aws_route53_register_deregister_instance.py --help': [
+            sys.executable, 'aws_route53_register_deregister_instance.py', '--help'],
+        'import lambda_bad_lambda_metrics'                  : [
+            sys.executable, '-c', 'import lambda_bad_lambda_metrics']
+    }
+    
+    for name, command in startup_commands.items():
+        
+        print('%s: %.3f seconds.' % (name, time_command(command, args.repeat, script_directory)))
+    
+    print('Importing boto3: %.3f seconds.' % time_command([sys.executable, '-c', 'import boto3'], args.repeat))
+    
+    import boto3
+    
+    # A client per call, as the scripts used to build them, against the shared one per service and region.
+    for service_name in ['route53', 'lambda', 'cloudwatch']:
+        
+        for region_name in args.regions:
+            
+            first_seconds, seconds = time_calls(lambda: boto3.client(service_name, region_name=region_name),
+                                                args.repeat)
+            print('boto3.client(%s, %s): first %.3f seconds, then %.4f seconds per client.' % (
+                service_name, region_name, first_seconds, seconds))
+            
+            first_seconds, seconds = time_calls(lambda: aws_clients.get_client(service_name, region_name),
+                                                args.repeat)
+            print('aws_clients.get_client(%s, %s): first %.3f seconds, then %.6f seconds per client.' % (
+                service_name, region_name, first_seconds, seconds))
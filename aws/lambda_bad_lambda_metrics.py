@@ -1,148 +1,792 @@
 #!/bin/python3
 
-import boto3
+import argparse
 import datetime
 import csv
+import heapq
+import json
+import math
+import sqlite3
+import sys
+import time
+from array import array
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from itertools import compress, groupby, islice
 
-if __name__ == '__main__':
+from aws_clients import RateLimiter, get_client, get_session
 
-    regions = ['ap-southeast-1', 'us-east-1', 'ap-south-1']
-    values = []
+# Metrics fetched per Lambda, as (metric name, statistic, unit). The metric name is also the report column.
+METRICS = [
+    ('Errors', 'Sum', 'Count'),
+    ('Invocations', 'Sum', 'Count'),
+    ('Duration', 'Average', 'Milliseconds'),
+    ('Throttles', 'Sum', 'Count')
+]
 
-    for region in regions:
+# Columns of every report, whatever mode produced it. Rows leave out the columns that do not apply to them.
+REPORT_COLUMNS = ['Function', 'region', 'window', 'LastModified'] + [metric_name for metric_name, stat, unit in METRICS]
 
-        # Get list of all Lambdas
-        next_token = ''
-        client = boto3.client('lambda', region_name=region)
+# Duration percentiles of the ranked report, over the period averages of the last week.
+DURATION_PERCENTILES = [50, 95, 99]
 
-        lambdas = []
-        while next_token != None:
+RANKED_COLUMNS = ['Rank', 'Function', 'region', 'Invocations', 'ErrorRate', 'ThrottleRate'] + \
+    ['DurationP%s' % percentile for percentile in DURATION_PERCENTILES] + ['ErrorRateChange', 'DurationChange']
 
-            params = {'MaxItems': 50}
-            if next_token != '':
+# Scores the worst Lambdas can be ranked by.
+RANK_KEYS = RANKED_COLUMNS[4:]
 
-                params['Marker'] = next_token
+# Rows the cached report reads from SQLite and writes at a time.
+REPORT_BATCH_ROWS = 1000
 
-            response = client.list_functions(
-                **params
-            )
+# GetMetricData takes up to 500 queries per call, which fits every metric of 125 Lambdas.
+MAX_QUERIES_PER_CALL = 500
+FUNCTIONS_PER_CALL = MAX_QUERIES_PER_CALL // len(METRICS)
 
-            for item in response['Functions']:
 
-                lambdas.append(item['FunctionName'])
+def get_lambda_regions():
+    """ Regions enabled for this account in which Lambda is available. """
 
-            next_token = response['NextMarker'] if 'NextMarker' in response else None
+    session = get_session()
 
-        # Get metrics for Lambdas
-        client = boto3.client('cloudwatch', region_name=region)
-        next_token = ''
+    # describe_regions only returns the regions enabled for the account, opt-in regions included once opted into.
+    response = get_client('ec2', region_name=session.region_name or 'us-east-1').describe_regions()
 
-        for my_lambda in lambdas:
+    enabled_regions = set([item['RegionName'] for item in response['Regions']])
 
-            print('> Processing %s...' % (my_lambda))
-
-            params = {
-
-                'MetricDataQueries': [
-                    {
-                        'Id': 'errors',
-                        'MetricStat': {
-                            'Metric': {
-                                'Namespace': 'AWS/Lambda',
-                                'MetricName': 'Errors',
-                                'Dimensions': [
-                                    {
-                                        'Name': 'FunctionName',
-                                        'Value': my_lambda
-                                    },
-                                ]
-                            },
-                            'Period': 86400,
-                            'Stat': 'Sum',
-                            'Unit': 'Count'
-                        },
-                    },                    
-                    {
-                        'Id': 'invocations',
-                        'MetricStat': {
-                            'Metric': {
-                                'Namespace': 'AWS/Lambda',
-                                'MetricName': 'Invocations',
-                                'Dimensions': [
-                                    {
-                                        'Name': 'FunctionName',
-                                        'Value': my_lambda
-                                    },
-                                ]
-                            },
-                            'Period': 86400,
-                            'Stat': 'Sum',
-                            'Unit': 'Count'
-                        },
-                    },
-                    {
-                        'Id': 'duration',
-                        'MetricStat': {
-                            'Metric': {
-                                'Namespace': 'AWS/Lambda',
-                                'MetricName': 'Duration',
-                                'Dimensions': [
-                                    {
-                                        'Name': 'FunctionName',
-                                        'Value': my_lambda
-                                    },
-                                ]
-                            },
-                            'Period': 86400,
-                            'Stat': 'Average',
-                            'Unit': 'Milliseconds'
-                        },
-                    },
-                    {
-                        'Id': 'throttles',
-                        'MetricStat': {
-                            'Metric': {
-                                'Namespace': 'AWS/Lambda',
-                                'MetricName': 'Throttles',
-                                'Dimensions': [
-                                    {
-                                        'Name': 'FunctionName',
-                                        'Value': my_lambda
-                                    },
-                                ]
+    return sorted(enabled_regions & set(session.get_available_regions('lambda')))
+
+
+def get_lambda_inventory(region: str, rate_limiter: RateLimiter = None):
+    """ Get [name, last modified] of all Lambdas in a region. """
+
+    client = get_client('lambda', region_name=region)
+
+    next_token = ''
+    lambdas = []
+    while next_token != None:
+
+        params = {'MaxItems': 50}
+        if next_token != '':
+
+            params['Marker'] = next_token
+
+        if rate_limiter is not None:
+
+            rate_limiter.acquire()
+
+        response = client.list_functions(
+            **params
+        )
+
+        for item in response['Functions']:
+
+            lambdas.append([item['FunctionName'], item['LastModified']])
+
+        next_token = response['NextMarker'] if 'NextMarker' in response else None
+
+    return lambdas
+
+
+def get_lambdas(region: str, rate_limiter: RateLimiter = None):
+    """ Get names of all Lambdas in a region. """
+
+    return [my_lambda for my_lambda, last_modified in get_lambda_inventory(region, rate_limiter)]
+
+
+def get_metric_queries(lambdas: list, period: int):
+    """ Metric data queries for every metric of a batch of Lambdas, and the function and metric of each query ID. """
+
+    queries = []
+    query_ids = {}
+    for function_index, my_lambda in enumerate(lambdas):
+
+        for metric_index, (metric_name, stat, unit) in enumerate(METRICS):
+
+            # Query IDs have to start with a lower case letter and may only hold letters, digits and underscores.
+            query_id = 'f%s_m%s' % (function_index, metric_index)
+            query_ids[query_id] = (my_lambda, metric_name)
+
+            queries.append({
+                'Id': query_id,
+                'MetricStat': {
+                    'Metric': {
+                        'Namespace': 'AWS/Lambda',
+                        'MetricName': metric_name,
+                        'Dimensions': [
+                            {
+                                'Name': 'FunctionName',
+                                'Value': my_lambda
                             },
-                            'Period': 86400,
-                            'Stat': 'Sum',
-                            'Unit': 'Count'
-                        },
+                        ]
                     },
-                ],
-                'StartTime': datetime.datetime.utcnow() - datetime.timedelta(hours=1),
-                'EndTime': datetime.datetime.now(),
-                'ScanBy': 'TimestampDescending',
-                'MaxDatapoints': 100
-            }
+                    'Period': period,
+                    'Stat': stat,
+                    'Unit': unit
+                },
+            })
+
+    return queries, query_ids
+
+
+def get_batch_metrics(region: str, lambdas: list, start_time: datetime.datetime, end_time: datetime.datetime,
+                      period: int = 86400, rate_limiter: RateLimiter = None):
+    """ Rows with the latest value of every metric per Lambda, for at most FUNCTIONS_PER_CALL Lambdas. """
+
+    client = get_client('cloudwatch', region_name=region)
+
+    queries, query_ids = get_metric_queries(lambdas, period)
+
+    rows = {}
+    for my_lambda in lambdas:
+
+        rows[my_lambda] = {'Function': my_lambda, 'region': region}
+        rows[my_lambda].update(dict.fromkeys([metric_name for metric_name, stat, unit in METRICS], 0))
+
+    params = {
+        'MetricDataQueries': queries,
+        'StartTime': start_time,
+        'EndTime': end_time,
+        'ScanBy': 'TimestampDescending'
+    }
+
+    # A query can come back on several pages. Newest values come first, so only the first one found is kept.
+    found = set()
+    while True:
+
+        if rate_limiter is not None:
+
+            rate_limiter.acquire()
+
+        response = client.get_metric_data(
+            **params
+        )
+
+        for item in response['MetricDataResults']:
+
+            if item['Id'] in found or not item.get('Values'):
+
+                continue
+
+            found.add(item['Id'])
+
+            my_lambda, metric_name = query_ids[item['Id']]
+            rows[my_lambda][metric_name] = round(item['Values'][0], 2)
+
+        if 'NextToken' not in response:
+
+            break
+
+        params['NextToken'] = response['NextToken']
+
+    return [rows[my_lambda] for my_lambda in lambdas]
+
+
+def get_batch_datapoints(region: str, lambdas: list, start_time: int, end_time: int, period: int,
+                         rate_limiter: RateLimiter = None):
+    """ Every datapoint between two timestamps of every metric per Lambda, as (timestamp, value) lists keyed by
+    (Lambda, metric name), for at most FUNCTIONS_PER_CALL Lambdas. """
+
+    client = get_client('cloudwatch', region_name=region)
+
+    queries, query_ids = get_metric_queries(lambdas, period)
+
+    datapoints = {}
+    for key in query_ids.values():
+
+        datapoints[key] = []
+
+    params = {
+        'MetricDataQueries': queries,
+        'StartTime': datetime.datetime.fromtimestamp(start_time, datetime.timezone.utc),
+        'EndTime': datetime.datetime.fromtimestamp(end_time, datetime.timezone.utc),
+        'ScanBy': 'TimestampAscending'
+    }
+
+    while True:
+
+        if rate_limiter is not None:
+
+            rate_limiter.acquire()
+
+        response = client.get_metric_data(
+            **params
+        )
+
+        for item in response['MetricDataResults']:
+
+            datapoints[query_ids[item['Id']]] += zip([int(timestamp.timestamp()) for timestamp in item['Timestamps']],
+                                                     item['Values'])
+
+        if 'NextToken' not in response:
+
+            break
+
+        params['NextToken'] = response['NextToken']
+
+    return datapoints
+
+
+class MetricsCache:
+    """ SQLite cache of Lambda inventories and metric datapoints, so a run only fetches the periods it has not seen.
+
+    A period is only marked as fetched once CloudWatch has settled it, so the current, incomplete period is fetched
+    again by every run. """
+
+    def __init__(self, path: str):
+
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS inventories (region TEXT PRIMARY KEY, listed_at REAL);
+            CREATE TABLE IF NOT EXISTS functions (region TEXT, function_name TEXT, last_modified TEXT,
+                                                  PRIMARY KEY (region, function_name));
+            CREATE TABLE IF NOT EXISTS datapoints (region TEXT, function_name TEXT, metric_name TEXT, period INTEGER,
+                                                   timestamp INTEGER, value REAL,
+                                                   PRIMARY KEY (region, function_name, metric_name, period, timestamp));
+            CREATE TABLE IF NOT EXISTS fetched_periods (region TEXT, function_name TEXT, period INTEGER,
+                                                        timestamp INTEGER,
+                                                        PRIMARY KEY (region, function_name, period, timestamp));
+        """)
+
+    def get_inventory(self, region: str, max_age: float):
+        """ Cached [name, last modified] of the Lambdas in a region, or None if it was listed too long ago. """
+
+        listed_at = self.connection.execute('SELECT listed_at FROM inventories WHERE region = ?', (region,)).fetchone()
+
+        if listed_at is None or listed_at[0] < time.time() - max_age:
+
+            return None
+
+        return [list(row) for row in self.connection.execute(
+            'SELECT function_name, last_modified FROM functions WHERE region = ? ORDER BY function_name', (region,))]
+
+    def set_inventory(self, region: str, lambdas: list):
+        """ Replace the inventory of a region, dropping everything cached for Lambdas that no longer exist. """
+
+        with self.connection:
+
+            self.connection.execute('DELETE FROM functions WHERE region = ?', (region,))
+            self.connection.executemany('INSERT INTO functions VALUES (?, ?, ?)',
+                                        [(region, my_lambda, last_modified) for my_lambda, last_modified in lambdas])
+            self.connection.execute('INSERT OR REPLACE INTO inventories VALUES (?, ?)', (region, time.time()))
+
+            for table in ['datapoints', 'fetched_periods']:
+
+                self.connection.execute('DELETE FROM ' + table + ' WHERE region = ? AND function_name NOT IN '
+                                        '(SELECT function_name FROM functions WHERE region = ?)', (region, region))
+
+    def get_fetch_plan(self, region: str, lambdas: list, start_time: int, end_time: int, period: int):
+        """ (start, end, Lambdas) calls that fetch every period between two timestamps missing from the cache.
+
+        Each Lambda is fetched from its first to its last missing period, and Lambdas missing the same span share
+        calls, FUNCTIONS_PER_CALL at a time. After an hourly run that is one short span for all of them. """
+
+        fetched = set(self.connection.execute(
+            'SELECT function_name, timestamp FROM fetched_periods WHERE region = ? AND period = ? AND timestamp >= ? '
+            'AND timestamp < ?', (region, period, start_time, end_time)))
+
+        spans = {}
+        for my_lambda in lambdas:
+
+            missing = [timestamp for timestamp in range(start_time, end_time, period)
+                       if (my_lambda, timestamp) not in fetched]
+
+            if missing:
+
+                spans.setdefault((missing[0], missing[-1] + period), []).append(my_lambda)
+
+        fetch_plan = []
+        for (span_start, span_end), span_lambdas in sorted(spans.items()):
+
+            for batch_start in range(0, len(span_lambdas), FUNCTIONS_PER_CALL):
+
+                fetch_plan.append((span_start, span_end, span_lambdas[batch_start:batch_start + FUNCTIONS_PER_CALL]))
+
+        return fetch_plan
+
+    def add_datapoints(self, region: str, lambdas: list, start_time: int, end_time: int, settled_time: int,
+                       period: int, datapoints: dict):
+        """ Store fetched datapoints, and mark the periods of the fetch that ended before settled_time as fetched. """
+
+        with self.connection:
+
+            self.connection.executemany('INSERT OR REPLACE INTO datapoints VALUES (?, ?, ?, ?, ?, ?)', [
+                (region, my_lambda, metric_name, period, timestamp, value)
+                for (my_lambda, metric_name), values in datapoints.items() for timestamp, value in values])
+
+            self.connection.executemany('INSERT OR IGNORE INTO fetched_periods VALUES (?, ?, ?, ?)', [
+                (region, my_lambda, period, timestamp) for my_lambda in lambdas
+                for timestamp in range(start_time, end_time, period) if timestamp + period <= settled_time])
+
+    def get_window_rows(self, region: str, start_time: int, end_time: int, period: int, window: str):
+        """ Yield a report row per Lambda of a region, with every metric rolled up over the periods of a time window.
+
+        Rows are rolled up by SQLite and streamed from the query, so they are never all in memory. """
+
+        metric_columns = []
+        params = []
+        for metric_name, stat, unit in METRICS:
+
+            metric_columns.append('COALESCE(%s(CASE WHEN d.metric_name = ? THEN d.value END), 0)' % (
+                'SUM' if stat == 'Sum' else 'AVG'))
+            params.append(metric_name)
+
+        cursor = self.connection.execute(
+            'SELECT f.function_name, f.last_modified, ' + ', '.join(metric_columns) + ' FROM functions f '
+            'LEFT JOIN datapoints d ON d.region = f.region AND d.function_name = f.function_name AND d.period = ? '
+            'AND d.timestamp >= ? AND d.timestamp < ? WHERE f.region = ? GROUP BY f.function_name '
+            'ORDER BY f.function_name', params + [period, start_time, end_time, region])
+
+        for row in cursor:
+
+            report_row = {'Function': row[0], 'region': region, 'window': window, 'LastModified': row[1]}
+
+            for (metric_name, stat, unit), value in zip(METRICS, row[2:]):
+
+                report_row[metric_name] = round(value, 2)
+
+            yield report_row
+
+    def get_week_totals(self, region: str, end_time: int, period: int):
+        """ Yield name, errors, invocations, throttles and average duration of every Lambda of a region over the week
+        up to end_time, followed by the same errors, invocations and average duration over the week before. """
+
+        week_start = end_time - 7 * 86400 // period * period
+        previous_week_start = week_start - 7 * 86400 // period * period
+
+        columns = []
+        params = []
+        for start_time, stop_time, metric_names in [(week_start, end_time, ['Errors', 'Invocations', 'Throttles']),
+                                                    (previous_week_start, week_start, ['Errors', 'Invocations'])]:
+
+            for metric_name in metric_names:
+
+                columns.append('COALESCE(SUM(CASE WHEN d.metric_name = ? AND d.timestamp >= ? AND d.timestamp < ? '
+                               'THEN d.value END), 0)')
+                params += [metric_name, start_time, stop_time]
+
+            columns.append('COALESCE(AVG(CASE WHEN d.metric_name = ? AND d.timestamp >= ? AND d.timestamp < ? '
+                           'THEN d.value END), 0)')
+            params += ['Duration', start_time, stop_time]
+
+        return self.connection.execute(
+            'SELECT f.function_name, ' + ', '.join(columns) + ' FROM functions f LEFT JOIN datapoints d ON '
+            'd.region = f.region AND d.function_name = f.function_name AND d.period = ? AND d.timestamp >= ? AND '
+            'd.timestamp < ? WHERE f.region = ? GROUP BY f.function_name ORDER BY f.function_name',
+            params + [period, previous_week_start, end_time, region])
+
+    def get_durations(self, region: str, start_time: int, end_time: int, period: int):
+        """ Yield name and average duration of every period with invocations of the Lambdas of a region, sorted by
+        name and duration. """
+
+        return self.connection.execute(
+            'SELECT function_name, value FROM datapoints WHERE region = ? AND metric_name = ? AND period = ? AND '
+            'timestamp >= ? AND timestamp < ? ORDER BY function_name, value',
+            (region, 'Duration', period, start_time, end_time))
+
+
+# CloudWatch can still add datapoints to a period for a few minutes after it ended.
+METRICS_SETTLE_SECONDS = 600
+
+
+def collect_cached_lambda_metrics(regions: list, cache: MetricsCache, days: list, period: int,
+                                  inventory_max_age: float, workers: int, requests_per_second: float,
+                                  report_writer):
+    """ Bring the cache up to date for the last max(days) days in every region, write rolling window rows per Lambda
+    for each number of days, and return the error of each region that failed. """
+
+    now = int(time.time())
+    end_time = (now // period + 1) * period
+    start_time = end_time - max(days) * 86400 // period * period
+    settled_time = (now - METRICS_SETTLE_SECONDS) // period * period
+
+    rate_limiters = {}
+    for region in regions:
+
+        rate_limiters[region] = RateLimiter(requests_per_second)
+
+    failed_regions = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+
+        fetches = {}
+
+        def plan_region(plan_region_name: str, lambdas: list):
+
+            fetch_plan = cache.get_fetch_plan(plan_region_name, lambdas, start_time, end_time, period)
+
+            print('> %s Lambdas in %s, fetching missing periods in %s calls.' % (len(lambdas), plan_region_name,
+                                                                                 len(fetch_plan)))
+
+            for fetch_start, fetch_end, batch in fetch_plan:
+
+                future = executor.submit(get_batch_datapoints, plan_region_name, batch, fetch_start, fetch_end, period,
+                                         rate_limiter=rate_limiters[plan_region_name])
+                fetches[future] = (plan_region_name, batch, fetch_start, fetch_end)
+
+        listings = {}
+        for region in regions:
+
+            inventory = cache.get_inventory(region, inventory_max_age)
+
+            if inventory is None:
+
+                listings[executor.submit(get_lambda_inventory, region, rate_limiters[region])] = region
+            else:
+
+                plan_region(region, [my_lambda for my_lambda, last_modified in inventory])
+
+        # The cache is only touched from this thread. The pool threads only call the APIs.
+        for future in as_completed(listings):
+
+            region = listings[future]
+
+            try:
+                inventory = future.result()
+            except Exception as e:
+                print('XXX Exception listing Lambdas in %s: %s' % (region, str(e)))
+                failed_regions[region] = e
+                continue
+
+            cache.set_inventory(region, inventory)
+            plan_region(region, [my_lambda for my_lambda, last_modified in inventory])
+
+        for future in as_completed(fetches):
+
+            # Dropping each future once its datapoints are cached keeps memory flat however many Lambdas there are.
+            region, batch, fetch_start, fetch_end = fetches.pop(future)
+
+            try:
+                cache.add_datapoints(region, batch, fetch_start, fetch_end, settled_time, period, future.result())
+            except Exception as e:
+                print('XXX Exception getting metrics in %s: %s' % (region, str(e)))
+                failed_regions[region] = e
+
+    for window_days in sorted(days):
+
+        for region in regions:
+
+            if region in failed_regions:
+
+                continue
+
+            rows = cache.get_window_rows(region, end_time - window_days * 86400 // period * period, end_time, period,
+                                         '%sd' % window_days)
+
+            batch = list(islice(rows, REPORT_BATCH_ROWS))
+            while batch:
+
+                report_writer.write_rows(batch)
+                batch = list(islice(rows, REPORT_BATCH_ROWS))
+
+    return failed_regions
+
+
+def collect_lambda_metrics(regions: list, start_time: datetime.datetime, end_time: datetime.datetime, workers: int,
+                           requests_per_second: float, report_writer):
+    """ Write metric rows of every Lambda in every region as each batch comes in, and return the error of each region
+    that failed.
+
+    Regions are listed concurrently, and the metric batches of a region start as soon as its listing is done. Each
+    region has its own rate limiter, as API limits apply per region, and a failing region does not stop the others. """
+
+    rate_limiters = {}
+    for region in regions:
+
+        rate_limiters[region] = RateLimiter(requests_per_second)
+
+    failed_regions = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+
+        listings = {}
+        for region in regions:
+
+            listings[executor.submit(get_lambdas, region, rate_limiters[region])] = region
+
+        batches = {}
+        for future in as_completed(listings):
+
+            region = listings[future]
+
+            try:
+                lambdas = future.result()
+            except Exception as e:
+                print('XXX Exception listing Lambdas in %s: %s' % (region, str(e)))
+                failed_regions[region] = e
+                continue
+
+            print('> Found %s Lambdas in %s.' % (len(lambdas), region))
+
+            for batch_start in range(0, len(lambdas), FUNCTIONS_PER_CALL):
+
+                batch = lambdas[batch_start:batch_start + FUNCTIONS_PER_CALL]
+                future = executor.submit(get_batch_metrics, region, batch, start_time, end_time,
+                                         rate_limiter=rate_limiters[region])
+                batches[future] = region
+
+        for future in as_completed(batches):
+
+            # Dropping each future once its rows are written keeps memory flat however many Lambdas there are.
+            region = batches.pop(future)
+
+            try:
+                rows = future.result()
+            except Exception as e:
+                print('XXX Exception getting metrics in %s: %s' % (region, str(e)))
+                failed_regions[region] = e
+                continue
+
+            report_writer.write_rows(rows)
+
+            print('>> Got metrics of %s Lambdas in %s.' % (len(rows), region))
+
+    return failed_regions
+
+
+def get_lambda_scores(cache: MetricsCache, regions: list, end_time: int, period: int):
+    """ Score every cached Lambda of the regions over the week up to end_time.
+
+    Scores are kept column-wise, one array per score, and each score is computed over the whole fleet in one pass. """
+
+    functions = []
+    function_regions = []
+    totals = [array('d') for index in range(7)]
+    for region in regions:
+
+        for row in cache.get_week_totals(region, end_time, period):
+
+            functions.append(row[0])
+            function_regions.append(region)
+
+            for column, value in zip(totals, row[1:]):
+
+                column.append(value)
+
+    errors, invocations, throttles, duration, previous_errors, previous_invocations, previous_duration = totals
+
+    def get_rate(count: float, total: float):
+
+        return count / total if total else 0.0
+
+    error_rates = array('d', map(get_rate, errors, invocations))
+    previous_error_rates = array('d', map(get_rate, previous_errors, previous_invocations))
+
+    scores = {
+        'Function': functions,
+        'region': function_regions,
+        'Invocations': invocations,
+        'ErrorRate': error_rates,
+        'ThrottleRate': array('d', map(get_rate, throttles, invocations)),
+        'ErrorRateChange': array('d', map(float.__sub__, error_rates, previous_error_rates)),
+        'DurationChange': array('d', [value / previous_value - 1 if previous_value else 0.0
+                                      for value, previous_value in zip(duration, previous_duration)])
+    }
+
+    # Percentiles come off durations sorted by SQLite, so only an index lookup is left per Lambda.
+    for percentile in DURATION_PERCENTILES:
+
+        scores['DurationP%s' % percentile] = array('d', bytes(8 * len(functions)))
+
+    indexes = dict([((region, function), index)
+                    for index, (region, function) in enumerate(zip(function_regions, functions))])
+
+    week_start = end_time - 7 * 86400 // period * period
+    for region in regions:
+
+        for function, rows in groupby(cache.get_durations(region, week_start, end_time, period), lambda row: row[0]):
+
+            if (region, function) not in indexes:
+
+                continue
+
+            values = array('d', [value for name, value in rows])
+
+            for percentile in DURATION_PERCENTILES:
+
+                scores['DurationP%s' % percentile][indexes[(region, function)]] = \
+                    values[max(math.ceil(percentile / 100 * len(values)) - 1, 0)]
+
+    return scores
+
+
+def get_worst_lambdas(scores: dict, rank_by: str, top: int, min_invocations: float):
+    """ Ranked report rows of the top Lambdas with the highest rank_by score, ignoring Lambdas with too few
+    invocations to have meaningful rates. """
+
+    candidates = compress(range(len(scores['Function'])),
+                          [value >= min_invocations for value in scores['Invocations']])
+
+    rows = []
+    for rank, index in enumerate(heapq.nlargest(top, candidates, key=scores[rank_by].__getitem__), 1):
+
+        row = {'Rank': rank}
+
+        for column in RANKED_COLUMNS[1:]:
+
+            row[column] = scores[column][index] if column in ['Function', 'region'] else \
+                round(scores[column][index], 4)
+
+        rows.append(row)
+
+    return rows
+
+
+class CsvReportWriter:
+    """ Report rows as CSV with a fixed header, flushed after every batch so the file is usable while it grows. """
+
+    def __init__(self, path: str, columns: list = REPORT_COLUMNS):
+
+        self.handler = open(path, 'w', newline='')
+        self.writer = csv.DictWriter(self.handler, columns, restval='')
+        self.writer.writeheader()
+
+    def write_rows(self, rows: list):
+
+        self.writer.writerows(rows)
+        self.handler.flush()
+
+    def close(self):
+
+        self.handler.close()
+
+
+class JsonLinesReportWriter:
+    """ Report rows as one JSON object per line, flushed after every batch. """
+
+    def __init__(self, path: str, columns: list = REPORT_COLUMNS):
+
+        self.handler = open(path, 'w')
+        self.columns = columns
+
+    def write_rows(self, rows: list):
+
+        for row in rows:
+
+            self.handler.write(json.dumps(dict([(column, row.get(column)) for column in self.columns])) + '\n')
+
+        self.handler.flush()
+
+    def close(self):
+
+        self.handler.close()
+
+
+class ParquetReportWriter:
+    """ Report rows as Parquet, one row group per batch, for accounts too large to load a CSV comfortably.
+
+    Needs pyarrow. The file is only readable once it is closed, as Parquet writes its footer last. """
+
+    def __init__(self, path: str, columns: list = REPORT_COLUMNS, text_columns: list = REPORT_COLUMNS[:4]):
+
+        import pyarrow
+        import pyarrow.parquet
+
+        self.pyarrow = pyarrow
+        self.columns = columns
+
+        fields = []
+        for column in columns:
+
+            fields.append((column, pyarrow.float64() if column not in text_columns else pyarrow.string()))
+
+        self.schema = pyarrow.schema(fields)
+        self.writer = pyarrow.parquet.ParquetWriter(path, self.schema)
+
+    def write_rows(self, rows: list):
+
+        columns = {}
+        for column in self.columns:
+
+            columns[column] = [row.get(column) for row in rows]
+
+        self.writer.write_table(self.pyarrow.Table.from_pydict(columns, schema=self.schema))
+
+    def close(self):
+
+        self.writer.close()
+
+
+REPORT_WRITERS = {'csv': CsvReportWriter, 'jsonl': JsonLinesReportWriter, 'parquet': ParquetReportWriter}
+
+
+def get_report_writer(report_format: str, path: str, columns: list = REPORT_COLUMNS,
+                      text_columns: list = REPORT_COLUMNS[:4]):
+    """ Writer of a report format. Only Parquet has typed columns, so only it is told which columns are text. """
+
+    if report_format == 'parquet':
+
+        return ParquetReportWriter(path, columns, text_columns)
+
+    return REPORT_WRITERS[report_format](path, columns)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--regions', nargs='+',
+                        help='Regions to report on. Defaults to every enabled region in which Lambda is available.')
+    parser.add_argument('--workers', type=int, default=16, help='Number of concurrent API calls.')
+    parser.add_argument('--requests_per_second', type=float, default=10,
+                        help='API requests per second per region.')
+    parser.add_argument('--cache',
+                        help='SQLite file caching Lambda inventories and metric datapoints. With it the report has '
+                             'rolling --days windows, and each run only fetches the periods missing from the cache.')
+    parser.add_argument('--output', default='my_bad_lambdas.csv', help='Report file.')
+    parser.add_argument('--format', choices=sorted(REPORT_WRITERS), default='csv',
+                        help='Report format. parquet needs pyarrow.')
+    parser.add_argument('--days', type=int, nargs='+', default=[7, 30], help='Rolling windows of --cache, in days.')
+    parser.add_argument('--period', type=int, default=3600, help='Metric period of --cache, in seconds.')
+    parser.add_argument('--inventory_max_age', type=float, default=86400,
+                        help='Seconds a cached Lambda inventory is used before the region is listed again.')
+    parser.add_argument('--top', type=int, default=0,
+                        help='Also rank the worst N Lambdas of the last week by --rank_by. Needs --cache, and --days '
+                             'of at least 14 for week over week changes.')
+    parser.add_argument('--rank_by', choices=RANK_KEYS, default='ErrorRate', help='Score to rank --top Lambdas by.')
+    parser.add_argument('--min_invocations', type=float, default=100,
+                        help='Lambdas with fewer invocations in the last week are left out of --top.')
+    parser.add_argument('--ranked_output', default='my_worst_lambdas.csv', help='Ranked report file of --top.')
+
+    args = parser.parse_args()
+
+    if args.top and not args.cache:
+
+        parser.error('--top needs --cache')
+
+    regions = args.regions or get_lambda_regions()
+
+    # Rows are written as they come in, so a run that fails late keeps what it collected.
+    writer = get_report_writer(args.format, args.output)
+
+    try:
+        if args.cache:
+
+            failed = collect_cached_lambda_metrics(regions, MetricsCache(args.cache), args.days, args.period,
+                                                   args.inventory_max_age, args.workers, args.requests_per_second,
+                                                   writer)
+        else:
 
-            response = client.get_metric_data(
+            end_time = datetime.datetime.utcnow()
+            start_time = end_time - datetime.timedelta(hours=1)
 
-                **params
-            )
+            failed = collect_lambda_metrics(regions, start_time, end_time, args.workers, args.requests_per_second,
+                                            writer)
+    finally:
+        writer.close()
 
-            if 'MetricDataResults' in response:
+    if args.top:
 
-                tmp = {'Function': my_lambda, 'region': region}
+        scores = get_lambda_scores(MetricsCache(args.cache), [region for region in regions if region not in failed],
+                                   (int(time.time()) // args.period + 1) * args.period, args.period)
 
-                for item in response['MetricDataResults']:
+        writer = get_report_writer(args.format, args.ranked_output, RANKED_COLUMNS, ['Function', 'region'])
+        worst_lambdas = get_worst_lambdas(scores, args.rank_by, args.top, args.min_invocations)
+        writer.write_rows(worst_lambdas)
+        writer.close()
 
-                    tmp[item['Label']] = round(
-                        item['Values'][0] if 'Values' in item and item['Values'] else 0, 2)
+        print('>> Ranked the worst %s of %s Lambdas by %s.' % (len(worst_lambdas), len(scores['Function']),
+                                                               args.rank_by))
 
-                print('>> Final values: %s' % (str(tmp)))
+    if failed:
 
-            values.append(tmp)
+        print('XXX No complete report for regions: %s' % ', '.join(sorted(failed)))
 
-    # Write metrics to CSV file
-    with open('my_bad_lambdas.csv', 'w') as output_file:
-        dict_writer = csv.DictWriter(output_file, values[0].keys())
-        dict_writer.writeheader()
-        dict_writer.writerows(values)
+        sys.exit(1)
@@ -0,0 +1,342 @@
+import argparse
+import datetime
+import gzip
+import json
+import multiprocessing
+import os
+import re
+import resource
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import migrate_mysql_to_influxdb as migrator
+
+
+class SyntheticCursor:
+    """ DB-API cursor over synthetic tables, answering the queries the migrator sends to MySQL. """
+    
+    def __init__(self, connection):
+        
+        self.connection = connection
+        self.rows = iter(())
+    
+    def execute(self, sql: str, params: tuple):
+        
+        table = self.connection.tables[re.search(r' FROM (\w+)', sql).group(1)]
+        
+        if sql.startswith('SELECT MIN('):
+            
+            self.rows = iter([(1, table['row_count']) if params[0] < table['row_count'] else (None, None)])
+        
+        else:
+            
+            last_state_value = params[0]
+            upper_bound = params[1] if len(params) == 3 else table['row_count']
+            limit = params[-1]
+            
+            first_id = last_state_value + 1
+            last_id = min(last_state_value + limit, upper_bound, table['row_count'])
+            
+            self.rows = (get_synthetic_row(table, row_id) for row_id in range(first_id, last_id + 1))
+    
+    def __iter__(self):
+        
+        return self.rows
+    
+    def fetchone(self):
+        
+        return next(self.rows, None)
+    
+    def close(self):
+        
+        self.rows = iter(())
+
+
+class SyntheticConnection:
+    """ Stand-in for a MySQLdb connection that generates table rows on the fly instead of storing them. """
+    
+    def __init__(self, tables: dict):
+        
+        self.tables = tables
+    
+    def cursor(self, cursor_class=None):
+        
+        return SyntheticCursor(self)
+    
+    def ping(self):
+        
+        pass
+    
+    def close(self):
+        
+        pass
+
+
+def get_synthetic_table(table_index: int, row_count: int, tag_count: int, field_count: int):
+    """ Build a migrator table config plus what is needed to generate its rows. """
+    
+    columns = []
+    for tag_index in range(tag_count):
+        
+        columns.append({'column_name': 'tag_%s' % tag_index, 'is_tag': True, 'type': 'string'})
+    
+    # Fields cycle through float, int and string columns, so every encoder path is exercised.
+    field_types = ['float', 'int', 'string']
+    for field_index in range(field_count):
+        
+        columns.append({'column_name': 'field_%s' % field_index, 'is_tag': False,
+                        'type': field_types[field_index % len(field_types)]})
+    
+    return {
+        'table_name'           : 'synthetic_%s' % table_index,
+        'measurement_name'     : 'synthetic_%s' % table_index,
+        'columns'              : columns,
+        'unix_timestamp_column': 'timestamp',
+        'auto_increment_column': 'id',
+        'row_count'            : row_count
+    }
+
+
+def get_synthetic_row(table: dict, row_id: int):
+    """ Deterministic row for an auto increment value, in get_select_sql() column order. """
+    
+    row = [1500000000 + row_id, row_id]
+    
+    for item in table['columns']:
+        
+        if item['is_tag']:
+            
+            row.append('host-%s' % (row_id % 50))
+        
+        elif item['type'] == 'float':
+            
+            row.append(row_id * 0.25)
+        
+        elif item['type'] == 'int':
+            
+            row.append(row_id % 1000)
+        else:
+            
+            row.append('status-%s' % (row_id % 7))
+    
+    return tuple(row)
+
+
+class FakeInfluxDBHandler(BaseHTTPRequestHandler):
+    """ Minimal InfluxDB /write endpoint that accepts, counts and discards line protocol. """
+    
+    protocol_version = 'HTTP/1.1'
+    
+    def do_POST(self):
+        
+        start_time = time.perf_counter()
+        
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        
+        if self.headers.get('Content-Encoding') == 'gzip':
+            
+            body = gzip.decompress(body)
+        
+        with self.server.stats_lock:
+            self.server.stats['points'] += body.count(b'\n') + 1
+            self.server.stats['requests'] += 1
+            self.server.stats['server_seconds'] += time.perf_counter() - start_time
+        
+        self.send_response(204)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+    
+    def log_message(self, format, *args):
+        
+        pass
+
+
+def start_fake_influxdb():
+    """ Start the fake InfluxDB server on a free local port, in a background thread. """
+    
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeInfluxDBHandler)
+    server.stats = {'points': 0, 'requests': 0, 'server_seconds': 0}
+    server.stats_lock = threading.Lock()
+    
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    
+    return server
+
+
+def get_mode_config(mode: str, args, tables: list, influxdb_port: int, checkpoint_file: str):
+    """ Migrator config for one benchmark mode. """
+    
+    config = dict(migrator.main_config)
+    config.update({
+        'checkpoint_file': checkpoint_file,
+        'spool_directory': os.path.join(os.path.dirname(checkpoint_file), 'spool'),
+        'influxdb_host'  : '127.0.0.1',
+        'influxdb_port'  : influxdb_port,
+        'chunk_size'     : args.chunk_size,
+        'catch_up'       : True,
+        'tables'         : tables,
+        'pipeline'       : mode != 'sequential',
+        'workers'        : args.workers if mode == 'parallel' else 1,
+        'mysql_pool_size': args.workers if mode == 'parallel' else 1
+    })
+    
+    return config
+
+
+def measure_chunk_memory(table: dict, chunk_size: int):
+    """ Memory held by one fetched chunk and the peak while building it, in KB, measured with tracemalloc. """
+    
+    connection = SyntheticConnection({table['table_name']: table})
+    
+    tracemalloc.start()
+    
+    rows = migrator.get_rows_from_mysql(connection, table, last_state_value=0, chunk_size=chunk_size, catch_up=False)
+    chunk = next(migrator.get_chunks(rows, chunk_size, table))
+    
+    held_bytes, peak_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    
+    del chunk
+    
+    return held_bytes // 1024, peak_bytes // 1024
+
+
+def run_mode(mode: str, args, results: multiprocessing.Queue):
+    """ Run one migrator mode against fresh stand-ins and report its measurements. Runs in its own process. """
+    
+    # The migrator prints a line per chunk, which would drown the benchmark report.
+    sys.stdout = open(os.devnull, 'w')
+    
+    tables = [get_synthetic_table(table_index, args.rows, args.tags, args.fields) for table_index in range(args.tables)]
+    
+    chunk_kb, chunk_peak_kb = measure_chunk_memory(tables[0], args.chunk_size)
+    
+    server = start_fake_influxdb()
+    
+    with tempfile.TemporaryDirectory() as directory:
+        
+        config = get_mode_config(mode, args, tables, server.server_address[1], os.path.join(directory, 'checkpoints'))
+        
+        checkpoint_store = migrator.CheckpointStore(config['checkpoint_file'])
+        
+        mysql_pool = migrator.MySQLConnectionPool(host='', username='', password='', db='',
+                                                  size=config['mysql_pool_size'],
+                                                  connect=lambda *connect_args, **connect_kwargs: SyntheticConnection(
+                                                      {table['table_name']: table for table in tables}))
+        
+        start_time = time.perf_counter()
+        migration_results = migrator.migrate_tables(config, mysql_pool, checkpoint_store)
+        seconds = time.perf_counter() - start_time
+    
+    server.shutdown()
+    
+    totals = migrator.get_empty_result()
+    for result in migration_results.values():
+        
+        migrator.merge_results(totals, result)
+    
+    results.put({
+        'mode'                : mode,
+        'points'              : totals['points'],
+        'points_received'     : server.stats['points'],
+        'seconds'             : round(seconds, 3),
+        'points_per_second'   : round(totals['points'] / seconds) if seconds else 0,
+        'fetch_seconds'       : round(totals['fetch_seconds'], 3),
+        'transform_seconds'   : round(totals['transform_seconds'], 3),
+        'write_seconds'       : round(totals['write_seconds'], 3),
+        'write_server_seconds': round(server.stats['server_seconds'], 3),
+        'write_requests'      : server.stats['requests'],
+        'retries'             : totals['retries'],
+        'bytes_sent'          : totals['bytes_sent'],
+        'chunk_kb'            : chunk_kb,
+        'chunk_peak_kb'       : chunk_peak_kb,
+        'max_rss_kb'          : resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    })
+
+
+def get_previous_results(path: str, parameters: dict):
+    """ Latest stored result per mode for the same benchmark parameters. """
+    
+    previous_results = {}
+    
+    if not os.path.exists(path):
+        
+        return previous_results
+    
+    with open(path, 'r') as handler:
+        
+        for line in handler:
+            
+            result = json.loads(line)
+            
+            if result['parameters'] == parameters:
+                
+                previous_results[result['mode']] = result
+    
+    return previous_results
+
+
+if __name__ == '__main__':
+    
+    parser = argparse.ArgumentParser()
+    
+    parser.add_argument('--rows', type=int, default=200000, help='Rows per synthetic table.')
+    parser.add_argument('--tables', type=int, default=4, help='Number of synthetic tables.')
+    parser.add_argument('--tags', type=int, default=3, help='Tag columns per table.')
+    parser.add_argument('--fields', type=int, default=12, help='Field columns per table.')
+    parser.add_argument('--chunk_size', type=int, default=10000, help='Migrator chunk size.')
+    parser.add_argument('--workers', type=int, default=4, help='Workers for the parallel mode.')
+    parser.add_argument('--modes', nargs='+', default=['sequential', 'pipeline', 'parallel'],
+                        choices=['sequential', 'pipeline', 'parallel'], help='Migrator modes to benchmark.')
+    parser.add_argument('--label', default='', help='Label stored with the results, e.g. a git revision.')
+    parser.add_argument('--output', default='benchmark_results.jsonl',
+                        help='JSON lines file the results are appended to and compared against.')
+    
+    args = parser.parse_args()
+    
+    benchmark_parameters = {
+        'rows'      : args.rows,
+        'tables'    : args.tables,
+        'tags'      : args.tags,
+        'fields'    : args.fields,
+        'chunk_size': args.chunk_size,
+        'workers'   : args.workers
+    }
+    
+    previous = get_previous_results(args.output, benchmark_parameters)
+    
+    # Every mode runs in a fresh process, so peak RSS is not inherited from the previous mode.
+    context = multiprocessing.get_context('spawn')
+    
+    for benchmark_mode in args.modes:
+        
+        mode_results = context.Queue()
+        process = context.Process(target=run_mode, args=(benchmark_mode, args, mode_results))
+        process.start()
+        measurement = mode_results.get()
+        process.join()
+        
+        measurement['parameters'] = benchmark_parameters
+        measurement['label'] = args.label
+        measurement['timestamp'] = datetime.datetime.utcnow().isoformat()
+        
+        with open(args.output, 'a') as output_file:
+            output_file.write(json.dumps(measurement, sort_keys=True) + '\n')
+        
+        print('%s: %s points/sec in %.2f seconds, fetch %.2fs, transform %.2fs, write %.2fs, max RSS %s KB, '
+              '%s KB per chunk.' % (benchmark_mode, measurement['points_per_second'], measurement['seconds'],
+                                    measurement['fetch_seconds'], measurement['transform_seconds'],
+                                    measurement['write_seconds'], measurement['max_rss_kb'], measurement['chunk_kb']))
+        
+        if benchmark_mode in previous:
+            
+            print('%s: %+.1f%% points/sec, %+.1f%% max RSS, %+.1f%% per chunk compared to %s (%s).' % (
+                benchmark_mode,
+                (measurement['points_per_second'] / previous[benchmark_mode]['points_per_second'] - 1) * 100,
+                (measurement['max_rss_kb'] / previous[benchmark_mode]['max_rss_kb'] - 1) * 100,
+                (measurement['chunk_kb'] / previous[benchmark_mode].get('chunk_kb', measurement['chunk_kb']) - 1) * 100,
+                previous[benchmark_mode]['label'] or 'unlabelled', previous[benchmark_mode]['timestamp']))
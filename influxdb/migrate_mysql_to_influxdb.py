@@ -1,6 +1,20 @@
 import MySQLdb
-from influxdb import InfluxDBClient
-import datetime
+import MySQLdb.cursors
+import argparse
+import gzip
+import http.client
+import json
+import os
+import queue
+import signal
+import struct
+import sys
+import threading
+import time
+from array import array
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from urllib.parse import urlencode
 
 
 def file_read(path: str):
@@ -17,45 +31,1792 @@ def file_read(path: str):
         return None
 
 
-def file_write(path: str, mode: str, content: str):
-    """ Write content to a file. """
+class CheckpointStore:
+    """ Single JSON checkpoint file for all tables, replaced atomically on every update. """
     
-    handler = open(path, mode)
+    def __init__(self, path: str, legacy_state_file_prefix: str = None):
+        
+        self.path = path
+        self.legacy_state_file_prefix = legacy_state_file_prefix
+        self.checkpoints = {}
+        self.lock = threading.Lock()
+        
+        if os.path.exists(path):
+            
+            with open(path, 'r') as handler:
+                self.checkpoints = json.load(handler)
+    
+    def get(self, table_name: str, default=0):
+        """ Get the last written auto increment value for a table. """
+        
+        with self.lock:
+            return self._get(table_name, default)
+    
+    def _get(self, table_name: str, default):
+        
+        if table_name not in self.checkpoints and self.legacy_state_file_prefix:
+            
+            legacy_state_file = self.legacy_state_file_prefix + table_name
+            
+            if os.path.exists(legacy_state_file):
+                
+                legacy_value = file_read(legacy_state_file)
+                
+                if legacy_value:
+                    
+                    self.checkpoints[table_name] = int(legacy_value)
+        
+        return self.checkpoints.get(table_name, default)
+    
+    def set(self, table_name: str, value):
+        """ Advance the checkpoint for a table and persist all checkpoints atomically. """
+        
+        with self.lock:
+            self.checkpoints[table_name] = value
+            self._persist()
+    
+    def update(self, values: dict):
+        """ Advance several checkpoints together, so they are never persisted out of step with each other. """
+        
+        with self.lock:
+            self.checkpoints.update(values)
+            self._persist()
+    
+    def delete(self, table_name: str):
+        """ Remove the checkpoint for a table, if any, and persist all checkpoints atomically. """
+        
+        with self.lock:
+            
+            if self.checkpoints.pop(table_name, None) is not None:
+                
+                self._persist()
+    
+    def _persist(self):
+        
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as handler:
+            json.dump(self.checkpoints, handler)
+            handler.flush()
+            os.fsync(handler.fileno())
+        
+        os.replace(tmp_path, self.path)
+        
+        directory = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+
+
+class MySQLConnectionPool:
+    """ Bounded pool of MySQL connections shared by the table workers.
+    
+    connect defaults to MySQLdb.connect, and can be swapped for any DB-API compatible source. """
+    
+    def __init__(self, host: str, username: str, password: str, db: str, size: int, connect=None, port: int = 3306):
+        
+        self.connect = connect or MySQLdb.connect
+        self.host = host
+        self.port = int(port)
+        self.username = username
+        self.password = password
+        self.db = db
+        self.connections = queue.Queue()
+        self.slots = threading.BoundedSemaphore(size)
+    
+    @contextmanager
+    def connection(self):
+        """ Borrow a connection, opening a new one only while the pool is below its size. """
+        
+        self.slots.acquire()
+        
+        try:
+            connection = self.connections.get_nowait()
+        except queue.Empty:
+            connection = None
+        
+        # Idle connections can be dropped by the server between daemon polls, so check before handing one out.
+        if connection is not None:
+            
+            try:
+                connection.ping()
+            except MySQLdb.Error:
+                connection.close()
+                connection = None
+        
+        try:
+            if connection is None:
+                
+                connection = self.connect(self.host, self.username, self.password, self.db, port=self.port)
+            
+            yield connection
+        
+        except Exception:
+            
+            if connection is not None:
+                
+                connection.close()
+                connection = None
+            raise
+        
+        finally:
+            
+            if connection is not None:
+                
+                self.connections.put(connection)
+            self.slots.release()
+    
+    def close(self):
+        """ Close all idle connections. """
+        
+        while not self.connections.empty():
+            
+            self.connections.get_nowait().close()
+
+
+class InfluxDBWriteError(Exception):
+    """ InfluxDB rejected a batch, or kept failing after all retries. """
+
+
+class InfluxDBRejectedError(InfluxDBWriteError):
+    """ InfluxDB answered a batch with a client error, so posting it again will not help. """
+
+
+class WriteSpool:
+    """ Append-only file of compressed batches that InfluxDB has not acknowledged yet.
+    
+    Records are an 8 byte length followed by the body. The offset of the first unacknowledged record is kept next to
+    the log, and the log is truncated once everything in it has been acknowledged. """
+    
+    def __init__(self, directory: str, name: str, max_bytes: int):
+        
+        os.makedirs(directory, exist_ok=True)
+        
+        self.path = os.path.join(directory, name + '.spool')
+        self.offset_path = self.path + '.offset'
+        self.rejected_path = self.path + '.rejected'
+        self.max_bytes = max_bytes
+        self.handler = open(self.path, 'ab')
+        
+        offset = file_read(self.offset_path) if os.path.exists(self.offset_path) else None
+        self.offset = min(int(offset) if offset else 0, self.get_size())
+        
+        # A crash while appending leaves a partial record at the end. Its rows were never checkpointed, so it is cut.
+        end_offset = self.offset
+        for end_offset, body in self.get_pending():
+            
+            pass
+        
+        if end_offset < self.get_size():
+            
+            print('Truncating partial record at offset %s of spool %s.' % (end_offset, self.path))
+            self.handler.truncate(end_offset)
+    
+    def get_size(self):
+        """ Size of the log file in bytes. """
+        
+        return os.fstat(self.handler.fileno()).st_size
+    
+    def get_pending_bytes(self):
+        """ Bytes of unacknowledged records. """
+        
+        return self.get_size() - self.offset
+    
+    def append(self, body: bytes):
+        """ Durably append one body to the log. """
+        
+        self.handler.write(struct.pack('>Q', len(body)) + body)
+        self.handler.flush()
+        os.fsync(self.handler.fileno())
+    
+    def get_pending(self):
+        """ Yield unacknowledged bodies in order, each with the offset just after it. """
+        
+        with open(self.path, 'rb') as reader:
+            
+            reader.seek(self.offset)
+            
+            while True:
+                
+                header = reader.read(8)
+                
+                if len(header) < 8:
+                    
+                    return
+                
+                body = reader.read(struct.unpack('>Q', header)[0])
+                
+                if len(body) < struct.unpack('>Q', header)[0]:
+                    
+                    return
+                
+                yield reader.tell(), body
+    
+    def ack(self, offset: int):
+        """ Mark every record before offset as acknowledged, truncating the log once all of it is. """
+        
+        if offset == self.offset:
+            
+            return
+        
+        if offset >= self.get_size():
+            
+            self.handler.truncate(0)
+            offset = 0
+        
+        self.offset = offset
+        
+        tmp_path = self.offset_path + '.tmp'
+        with open(tmp_path, 'w') as handler:
+            handler.write(str(offset))
+            handler.flush()
+            os.fsync(handler.fileno())
+        
+        os.replace(tmp_path, self.offset_path)
+    
+    def reject(self, body: bytes):
+        """ Set a body InfluxDB refused aside, so it does not block the records after it. """
+        
+        with open(self.rejected_path, 'ab') as handler:
+            handler.write(struct.pack('>Q', len(body)) + body)
+    
+    def close(self):
+        """ Close the log file. """
+        
+        self.handler.close()
+
+
+class InfluxDBWriter:
+    """ Post line-protocol batches to InfluxDB's /write endpoint over one keep-alive HTTP connection. """
+    
+    def __init__(self, host: str, port: int, database: str, precision: str, max_batch_bytes: int,
+                 max_batch_points: int, compress: bool = True, max_retries: int = 5, timeout: int = 30):
+        
+        self.host = host
+        self.port = int(port)
+        self.path = '/write?' + urlencode({'db': database, 'precision': precision})
+        self.max_batch_bytes = max_batch_bytes
+        self.max_batch_points = max_batch_points
+        self.compress = compress
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.connection = None
+        self.retries = 0
+        
+        self.headers = {'Content-Type': 'application/octet-stream'}
+        if compress:
+            
+            self.headers['Content-Encoding'] = 'gzip'
+    
+    def get_batches(self, lines: list):
+        """ Split lines into batches bounded by both point count and uncompressed byte size. """
+        
+        batch = []
+        batch_bytes = 0
+        for line in lines:
+            
+            if batch and (len(batch) >= self.max_batch_points or batch_bytes + len(line) > self.max_batch_bytes):
+                
+                yield batch
+                batch = []
+                batch_bytes = 0
+            
+            batch.append(line)
+            batch_bytes += len(line) + 1
+        
+        if batch:
+            
+            yield batch
+    
+    def write(self, lines: list, spool: WriteSpool = None, max_retries: int = None):
+        """ Write encoded lines, retrying only the batch that failed. Return bytes before and after compression.
+        
+        With a spool, batches are appended to it first and then drained, so they are safe on disk even while InfluxDB
+        is down. """
+        
+        bytes_raw = 0
+        bytes_sent = 0
+        
+        for batch in self.get_batches(lines):
+            
+            body = b'\n'.join(batch)
+            bytes_raw += len(body)
+            
+            if self.compress:
+                
+                body = gzip.compress(body, compresslevel=1)
+            
+            if spool is None:
+                
+                self.post(body, max_retries)
+            else:
+                
+                spool.append(body)
+            
+            bytes_sent += len(body)
+        
+        if spool is not None:
+            
+            self.drain(spool)
+        
+        return bytes_raw, bytes_sent
+    
+    def drain(self, spool: WriteSpool):
+        """ Post spooled batches in order and acknowledge the ones InfluxDB accepted.
+        
+        While the spool is below its size limit a failed post just leaves the rest for the next drain. Above it the
+        usual retries apply, and giving up raises, which stops reading from MySQL until InfluxDB is back. """
+        
+        over_limit = spool.get_pending_bytes() > spool.max_bytes
+        acked_offset = spool.offset
+        
+        try:
+            for offset, body in spool.get_pending():
+                
+                try:
+                    self.post(body, self.max_retries if over_limit else 0)
+                except InfluxDBRejectedError as e:
+                    print('XXX InfluxDB rejected a spooled batch, moving it to %s: %s' % (spool.rejected_path, str(e)))
+                    spool.reject(body)
+                
+                acked_offset = offset
+        
+        except InfluxDBWriteError:
+            
+            if over_limit:
+                
+                raise
+            
+            print('XXX InfluxDB unavailable, %s bytes left in spool %s.' % (
+                spool.get_size() - acked_offset, spool.path))
+        
+        finally:
+            
+            spool.ack(acked_offset)
+    
+    def post(self, body: bytes, max_retries: int = None):
+        """ Post one batch, reconnecting and backing off on connection errors and retryable responses. """
+        
+        max_retries = self.max_retries if max_retries is None else max_retries
+        
+        counter = 1
+        reconnected = False
+        while True:
+            
+            reused_connection = self.connection is not None
+            
+            try:
+                if self.connection is None:
+                    
+                    self.connection = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+                
+                self.connection.request('POST', self.path, body=body, headers=self.headers)
+                response = self.connection.getresponse()
+                message = response.read()
+                
+                if response.status == 204:
+                    
+                    return
+                
+                error = 'HTTP %s: %s' % (response.status, message.decode(errors='replace'))
+                
+                if response.status < 500 and response.status != 429:
+                    
+                    raise InfluxDBRejectedError(error)
+            
+            except (http.client.HTTPException, OSError) as e:
+                
+                self.close()
+                error = str(e)
+                
+                # A keep-alive connection closed by InfluxDB or a proxy while idle fails on its first use. That is
+                # retried once right away on a new connection, rather than counted as a failed attempt.
+                if reused_connection and not reconnected and isinstance(e, ConnectionError):
+                    
+                    reconnected = True
+                    continue
+            
+            if counter > max_retries:
+                
+                raise InfluxDBWriteError('Giving up after %s retries: %s' % (max_retries, error))
+            
+            self.retries += 1
+            sleepy_time = counter ** 2
+            print('XXX InfluxDB write failed: %s' % error)
+            print('XXX Iteration %s, sleeping for %s seconds.' % (str(counter), str(sleepy_time)))
+            time.sleep(sleepy_time)
+            
+            counter += 1
+    
+    def close(self):
+        """ Close the HTTP connection. """
+        
+        if self.connection is not None:
+            
+            self.connection.close()
+            self.connection = None
+
+
+influxdb_writers = threading.local()
+
+
+def get_influxdb_writer(config: dict):
+    """ Get the InfluxDB writer of the current worker thread, so its connection is reused across tables. """
+    
+    if not hasattr(influxdb_writers, 'writer'):
+        
+        influxdb_writers.writer = InfluxDBWriter(host=config['influxdb_host'], port=config['influxdb_port'],
+                                                 database=config['influxdb_database'],
+                                                 precision=config['influxdb_precision'],
+                                                 max_batch_bytes=config['influxdb_batch_bytes'],
+                                                 max_batch_points=config['influxdb_batch_points'],
+                                                 compress=config['influxdb_gzip'],
+                                                 max_retries=config['influxdb_retries'])
+    
+    return influxdb_writers.writer
+
+
+# Position of the timestamp and auto increment columns in every row returned by get_select_sql().
+TIMESTAMP_POSITION = 0
+AUTO_INCREMENT_POSITION = 1
+
+TIME_PRECISION_MULTIPLIERS = {'s': 1, 'ms': 1000, 'u': 1000000, 'n': 1000000000}
+
+MEASUREMENT_ESCAPES = str.maketrans({',': '\\,', ' ': '\\ '})
+# Same escapes as influxdb-python. A raw newline would end the line and fail the whole batch, and a trailing
+# backslash in a tag value would escape the separator after it.
+KEY_ESCAPES = str.maketrans({',': '\\,', '=': '\\=', ' ': '\\ ', '\\': '\\\\', '\n': '\\n'})
+STRING_FIELD_ESCAPES = str.maketrans({'"': '\\"', '\\': '\\\\', '\n': '\\n'})
+
+FIELD_DEFAULTS = {'string': '', 'int': 0, 'float': 0.0}
+
+COLUMN_TYPECODES = {'int': 'q', 'float': 'd'}
+
+FIELD_FORMATTERS = {
+    'string': lambda value: '"' + str(value).translate(STRING_FIELD_ESCAPES) + '"',
+    'int'   : lambda value: '%di' % value,
+    'float' : lambda value: repr(float(value))
+}
+
+
+def get_select_sql(table: dict, upper_bound: int = None):
+    """ Build the keyset pagination query for a table, optionally capped at an upper auto increment value. """
+    
+    columns_list = [table['unix_timestamp_column'], table['auto_increment_column']]
+    for item in table['columns']:
+        
+        columns_list.append(item['column_name'])
+    
+    sql = 'SELECT ' + ','.join(columns_list) + ' FROM ' + table['table_name'] + ' WHERE ' + table[
+        'auto_increment_column'] + ' > %s'
+    
+    if upper_bound is not None:
+        
+        sql += ' AND ' + table['auto_increment_column'] + ' <= %s'
+    
+    return sql + ' ORDER BY ' + table['auto_increment_column'] + ' LIMIT %s'
+
+
+def get_rows_from_mysql(connection, table: dict, last_state_value: int, chunk_size: int, catch_up: bool,
+                        upper_bound: int = None, metrics: dict = None):
+    """ Stream rows from a MySQL table, one keyset page at a time, using a server-side cursor. """
+    
+    sql = get_select_sql(table, upper_bound)
+    
+    while True:
+        
+        cursor = connection.cursor(MySQLdb.cursors.SSCursor)
+        row_count = 0
+        
+        if upper_bound is None:
+            
+            params = (last_state_value, chunk_size)
+        else:
+            
+            params = (last_state_value, upper_bound, chunk_size)
+        
+        try:
+            cursor.execute(sql, params)
+            
+            for row in cursor:
+                
+                row_count += 1
+                last_state_value = row[AUTO_INCREMENT_POSITION]
+                
+                yield row
+        finally:
+            cursor.close()
+        
+        # A full last page means the table may have more rows than were read.
+        if metrics is not None:
+            
+            metrics['last_page_full'] = row_count >= chunk_size
+        
+        if not catch_up or row_count < chunk_size:
+            
+            break
+
+
+class ColumnChunk:
+    """ Rows of a table stored column by column instead of as one tuple per row.
+    
+    Timestamps, auto increment values and int and float fields are typed arrays of 8 byte values rather than lists of
+    Python objects, and strings are interned so a value repeated across rows is stored once. Missing field values are
+    replaced by their default on the way in, missing tag values are kept as None. """
+    
+    def __init__(self, columns: list):
+        
+        self.timestamps = array('d')
+        self.ids = array('q')
+        self.columns = []
+        self.appenders = []
+        
+        for item in columns:
+            
+            typecode = None if item['is_tag'] else COLUMN_TYPECODES.get(item['type'])
+            column = array(typecode) if typecode else []
+            
+            self.columns.append(column)
+            self.appenders.append(get_column_appender(column, None if item['is_tag'] else FIELD_DEFAULTS[item['type']]))
+    
+    def __len__(self):
+        
+        return len(self.ids)
+    
+    def append(self, row: tuple):
+        """ Add one row in get_select_sql() column order. Rows without an auto increment value get 0. """
+        
+        self.timestamps.append(row[TIMESTAMP_POSITION])
+        self.ids.append(row[AUTO_INCREMENT_POSITION] or 0)
+        
+        for append, value in zip(self.appenders, row[AUTO_INCREMENT_POSITION + 1:]):
+            
+            append(value)
+
+
+def get_column_appender(column, default):
+    """ Function adding one value to a ColumnChunk column, converting it to what the column stores. """
+    
+    append = column.append
+    
+    if isinstance(column, array) and column.typecode == 'q':
+        
+        def append_int(value):
+            
+            append(int(value or 0))
+        
+        return append_int
+    
+    if isinstance(column, array):
+        
+        def append_float(value):
+            
+            append(value or 0.0)
+        
+        return append_float
+    
+    def append_string(value):
+        
+        if type(value) is str:
+            
+            append(sys.intern(value) if value else default)
+        else:
+            
+            append(default if value is None else value)
+    
+    return append_string
+
+
+def get_chunks(rows, chunk_size: int, table: dict):
+    """ Group a row generator into ColumnChunks of at most chunk_size rows. """
+    
+    chunk = ColumnChunk(table['columns'])
+    for row in rows:
+        
+        chunk.append(row)
+        
+        if len(chunk) >= chunk_size:
+            
+            yield chunk
+            chunk = ColumnChunk(table['columns'])
+    
+    if len(chunk):
+        
+        yield chunk
+
+
+def get_chunks_from_mysql(mysql_pool: MySQLConnectionPool, table: dict, last_state_value: int, chunk_size: int,
+                          catch_up: bool, stop_event: threading.Event = None, upper_bound: int = None,
+                          metrics: dict = None):
+    """ Stream chunks of rows from a table on a connection borrowed from the pool, until caught up or stopped. """
+    
+    with mysql_pool.connection() as connection:
+        
+        rows = get_rows_from_mysql(connection=connection, table=table, last_state_value=last_state_value,
+                                   chunk_size=chunk_size, catch_up=catch_up, upper_bound=upper_bound, metrics=metrics)
+        
+        start_time = time.perf_counter()
+        for chunk in get_chunks(rows, chunk_size, table):
+            
+            if metrics is not None:
+                
+                metrics['fetch_seconds'] += time.perf_counter() - start_time
+            
+            yield chunk
+            
+            start_time = time.perf_counter()
+            
+            if stop_event is not None and stop_event.is_set():
+                
+                break
+
+
+PIPELINE_END = object()
+
+
+def put_until_stopped(target_queue: queue.Queue, item, stop_event: threading.Event):
+    """ Put an item on a bounded queue, giving up if the consumer has stopped. """
+    
+    while not stop_event.is_set():
+        
+        try:
+            target_queue.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    
+    return False
+
+
+def prefetch(iterable, queue_size: int):
+    """ Run an iterable in a background thread, handing its items over through a bounded queue. """
+    
+    items = queue.Queue(maxsize=queue_size)
+    stop_event = threading.Event()
+    
+    def produce():
+        
+        error = None
+        try:
+            for item in iterable:
+                
+                if not put_until_stopped(items, (item, None), stop_event):
+                    
+                    break
+        
+        except Exception as e:
+            error = e
+        
+        finally:
+            
+            if hasattr(iterable, 'close'):
+                
+                iterable.close()
+        
+        put_until_stopped(items, (PIPELINE_END, error), stop_event)
+    
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    
+    try:
+        while True:
+            
+            item, error = items.get()
+            
+            if item is PIPELINE_END:
+                
+                if error is not None:
+                    
+                    raise error
+                
+                return
+            
+            yield item
+    
+    finally:
+        
+        stop_event.set()
+        thread.join()
+
+
+def get_line_protocol_encoder(table: dict, precision: str):
+    """ Compile a function that encodes a ColumnChunk of a table to line-protocol lines, one column at a time. """
+    
+    measurement = table['measurement_name'].translate(MEASUREMENT_ESCAPES)
+    timestamp_multiplier = TIME_PRECISION_MULTIPLIERS[precision]
+    
+    tags = []
+    fields = []
+    for index, item in enumerate(table['columns']):
+        
+        key = item['column_name'].translate(KEY_ESCAPES) + '='
+        
+        if item['is_tag']:
+            
+            tags.append((key, index))
+        else:
+            
+            fields.append((key, index, FIELD_FORMATTERS[item['type']]))
+    
+    # InfluxDB recommends sorting tags by key, and doing it once here saves the server doing it per point.
+    tags.sort()
+    
+    def encode_chunk(chunk: ColumnChunk):
+        
+        tag_columns = []
+        for key, index in tags:
+            
+            # Each distinct tag value is escaped once per chunk. Empty tag values are not valid in line protocol, so
+            # the tag is left out for them.
+            pieces = {}
+            for value in set(chunk.columns[index]):
+                
+                pieces[value] = '' if value is None or value == '' else ',' + key + str(value).translate(
+                    KEY_ESCAPES)
+            
+            tag_columns.append([pieces[value] for value in chunk.columns[index]])
+        
+        field_columns = [[key + formatter(value) for value in chunk.columns[index]] for key, index, formatter in fields]
+        
+        timestamps = [' ' + str(int(timestamp * timestamp_multiplier)) for timestamp in chunk.timestamps]
+        
+        row_tags = zip(*tag_columns) if tag_columns else [()] * len(chunk)
+        
+        return [(measurement + ''.join(tag_pieces) + ' ' + ','.join(field_pieces) + timestamp).encode()
+                for tag_pieces, field_pieces, timestamp in zip(row_tags, zip(*field_columns), timestamps)]
+    
+    return encode_chunk
+
+
+def get_encoded_batches(chunks, encode_chunk, metrics: dict = None):
+    """ Encode chunks of rows to line-protocol lines, with the last auto increment value and timestamp of each. """
+    
+    for chunk in chunks:
+        
+        start_time = time.perf_counter()
+        lines = encode_chunk(chunk)
+        
+        if metrics is not None:
+            
+            metrics['transform_seconds'] += time.perf_counter() - start_time
+        
+        yield lines, chunk.ids[-1], chunk.timestamps[-1], None
+
+
+# Output field type of each aggregation function, None meaning the type of the source column.
+AGGREGATE_OUTPUT_TYPES = {'sum': None, 'mean': 'float', 'min': None, 'max': None, 'count': 'int', 'last': None}
+
+
+class ChunkAggregator:
+    """ Roll rows up into time buckets per tag group, keeping buckets that are still open across chunks.
+    
+    Rows are expected in timestamp order, give or take lateness_buckets buckets. A bucket is only emitted once a row
+    more than lateness_buckets buckets newer has been seen, and rows that arrive for an emitted bucket are dropped and
+    counted as late. Open buckets are never emitted early: the checkpoint stays before their first row instead, so
+    the next run reads them again and emits them complete.
+    
+    A closed bucket can hold rows after the checkpoint, which the next run reads again. emitted_bucket is the oldest
+    bucket that was not emitted yet, saved with the checkpoint, so on resume those rows are counted as late instead
+    of opening the emitted bucket again with a partial value. """
+    
+    def __init__(self, table: dict, emitted_bucket: int = None):
+        
+        aggregate = table['aggregate']
+        
+        self.bucket_seconds = aggregate['bucket_seconds']
+        self.lateness_seconds = aggregate.get('lateness_buckets', 1) * self.bucket_seconds
+        
+        columns = {}
+        for index, item in enumerate(table['columns']):
+            
+            columns[item['column_name']] = (index, item)
+        
+        group_by = aggregate.get('group_by', [item['column_name'] for item in table['columns'] if item['is_tag']])
+        
+        self.group_indexes = [columns[column_name][0] for column_name in group_by]
+        output_columns = [{'column_name': column_name, 'is_tag': True, 'type': 'string'} for column_name in group_by]
+        
+        self.fields = []
+        for column_name, function in sorted(aggregate['fields'].items()):
+            
+            index, item = columns[column_name]
+            
+            if item['type'] not in COLUMN_TYPECODES and function not in ['count', 'last']:
+                
+                raise ValueError('Cannot aggregate %s column %s with %s.' % (item['type'], column_name, function))
+            
+            self.fields.append((index, function, item['type'], FIELD_DEFAULTS[item['type']]))
+            output_columns.append({'column_name': column_name, 'is_tag': False,
+                                   'type': AGGREGATE_OUTPUT_TYPES[function] or item['type']})
+        
+        # Closed buckets are returned as a ColumnChunk of this table, so the line-protocol encoder is reused for them.
+        self.output_table = {'measurement_name': table['measurement_name'], 'columns': output_columns}
+        
+        self.newest_bucket = None
+        self.emitted_bucket = emitted_bucket
+        self.late_rows = 0
+        self.last_id = None
+        self.reset_state([])
+    
+    def reset_state(self, keys: list):
+        """ Start new state arrays, holding one slot per (bucket, group) key. """
+        
+        self.keys = keys
+        self.slots = {key: slot for slot, key in enumerate(keys)}
+        self.first_ids = array('q')
+        self.last_ids = array('q')
+        self.counts = array('q')
+        self.states = []
+        
+        for index, function, field_type, default in self.fields:
+            
+            if function in ['sum', 'mean', 'min', 'max'] or (function == 'last' and field_type in COLUMN_TYPECODES):
+                
+                self.states.append(array('d' if function == 'mean' else COLUMN_TYPECODES[field_type]))
+            else:
+                
+                self.states.append([])
+    
+    def get_oldest_open_bucket(self):
+        """ Oldest bucket that still takes rows, or None if no bucket was closed yet. """
+        
+        if self.newest_bucket is None:
+            
+            return self.emitted_bucket
+        
+        oldest_open_bucket = self.newest_bucket - self.lateness_seconds
+        
+        if self.emitted_bucket is not None and self.emitted_bucket > oldest_open_bucket:
+            
+            return self.emitted_bucket
+        
+        return oldest_open_bucket
+    
+    def add_slot(self, key: tuple, chunk: ColumnChunk, row_index: int):
+        """ Open a new bucket, seeded from its first row. """
+        
+        self.slots[key] = len(self.keys)
+        self.keys.append(key)
+        self.first_ids.append(chunk.ids[row_index])
+        self.last_ids.append(chunk.ids[row_index])
+        self.counts.append(0)
+        
+        for (index, function, field_type, default), state in zip(self.fields, self.states):
+            
+            state.append(0 if function in ['sum', 'mean', 'count'] else chunk.columns[index][row_index] or default)
+    
+    def add(self, chunk: ColumnChunk):
+        """ Add a chunk of rows to the open buckets. """
+        
+        width = self.bucket_seconds
+        buckets = [int(timestamp - timestamp % width) for timestamp in chunk.timestamps]
+        row_indexes = None
+        
+        # Only buckets closed by earlier chunks or runs are gone. Rows for them are late, the rest of the chunk is in
+        # order.
+        oldest_open_bucket = self.get_oldest_open_bucket()
+        if oldest_open_bucket is not None:
+            
+            kept_indexes = [row_index for row_index, bucket in enumerate(buckets) if bucket >= oldest_open_bucket]
+            
+            if len(kept_indexes) < len(buckets):
+                
+                row_indexes = kept_indexes
+                buckets = [buckets[row_index] for row_index in row_indexes]
+                
+                self.late_rows += len(chunk) - len(row_indexes)
+        
+        self.last_id = chunk.ids[-1]
+        
+        if not buckets:
+            
+            return
+        
+        chunk_newest_bucket = max(buckets)
+        if self.newest_bucket is None or chunk_newest_bucket > self.newest_bucket:
+            
+            self.newest_bucket = chunk_newest_bucket
+        
+        def get_column(column):
+            
+            return column if row_indexes is None else [column[row_index] for row_index in row_indexes]
+        
+        groups = zip(*[get_column(chunk.columns[index]) for index in self.group_indexes]) \
+            if self.group_indexes else [()] * len(buckets)
+        
+        if row_indexes is None:
+            
+            row_indexes = range(len(chunk))
+        
+        slot_column = array('q')
+        for row_index, bucket, group in zip(row_indexes, buckets, groups):
+            
+            key = (bucket, group)
+            
+            if key not in self.slots:
+                
+                self.add_slot(key, chunk, row_index)
+            
+            slot_column.append(self.slots[key])
+        
+        counts = self.counts
+        last_ids = self.last_ids
+        for slot, row_id in zip(slot_column, get_column(chunk.ids)):
+            
+            counts[slot] += 1
+            last_ids[slot] = row_id
+        
+        # Each aggregate is one pass over the column of its field, rather than a dispatch per row and field.
+        for (index, function, field_type, default), state in zip(self.fields, self.states):
+            
+            if function == 'count':
+                
+                continue
+            
+            values = get_column(chunk.columns[index])
+            
+            # Only tag columns keep missing values, typed field columns already hold their default.
+            if not isinstance(values, array):
+                
+                values = [value or default for value in values]
+            
+            if function in ['sum', 'mean']:
+                
+                for slot, value in zip(slot_column, values):
+                    
+                    state[slot] += value
+            
+            elif function == 'min':
+                
+                for slot, value in zip(slot_column, values):
+                    
+                    if value < state[slot]:
+                        
+                        state[slot] = value
+            
+            elif function == 'max':
+                
+                for slot, value in zip(slot_column, values):
+                    
+                    if value > state[slot]:
+                        
+                        state[slot] = value
+            else:
+                
+                for slot, value in zip(slot_column, values):
+                    
+                    state[slot] = value
+    
+    def pop_closed(self):
+        """ Remove closed buckets and return them as a ColumnChunk of output_table, with the highest checkpoint that
+        leaves no open bucket partially behind it. Afterwards emitted_bucket is the oldest bucket not emitted yet. """
+        
+        closed_chunk = ColumnChunk(self.output_table['columns'])
+        
+        oldest_open_bucket = self.get_oldest_open_bucket()
+        
+        if oldest_open_bucket is None:
+            
+            return closed_chunk, self.last_id
+        
+        self.emitted_bucket = oldest_open_bucket
+        
+        closed_rows = []
+        open_slots = []
+        for slot, (bucket, group) in enumerate(self.keys):
+            
+            if bucket >= oldest_open_bucket:
+                
+                open_slots.append(slot)
+                continue
+            
+            values = []
+            for (index, function, field_type, default), state in zip(self.fields, self.states):
+                
+                if function == 'count':
+                    
+                    values.append(self.counts[slot])
+                
+                elif function == 'mean':
+                    
+                    values.append(state[slot] / self.counts[slot])
+                else:
+                    
+                    values.append(state[slot])
+            
+            closed_rows.append((bucket, self.last_ids[slot]) + group + tuple(values))
+        
+        if len(open_slots) < len(self.keys):
+            
+            first_ids = self.first_ids
+            last_ids = self.last_ids
+            counts = self.counts
+            states = self.states
+            
+            self.reset_state([self.keys[slot] for slot in open_slots])
+            
+            self.first_ids.extend([first_ids[slot] for slot in open_slots])
+            self.last_ids.extend([last_ids[slot] for slot in open_slots])
+            self.counts.extend([counts[slot] for slot in open_slots])
+            
+            for new_state, state in zip(self.states, states):
+                
+                new_state.extend([state[slot] for slot in open_slots])
+        
+        closed_rows.sort(key=lambda closed_row: closed_row[TIMESTAMP_POSITION])
+        
+        for closed_row in closed_rows:
+            
+            closed_chunk.append(closed_row)
+        
+        if self.first_ids:
+            
+            return closed_chunk, min(self.first_ids) - 1
+        
+        return closed_chunk, self.last_id
+
+
+def get_aggregated_batches(chunks, aggregator: ChunkAggregator, encode_chunk, metrics: dict = None):
+    """ Aggregate chunks of rows and encode the buckets they close, with the checkpoint that is safe after each and
+    the oldest bucket not emitted yet. """
+    
+    for chunk in chunks:
+        
+        start_time = time.perf_counter()
+        
+        aggregator.add(chunk)
+        closed_chunk, checkpoint = aggregator.pop_closed()
+        lines = encode_chunk(closed_chunk)
+        
+        if metrics is not None:
+            
+            metrics['transform_seconds'] += time.perf_counter() - start_time
+            metrics['late_rows'] = aggregator.late_rows
+        
+        yield lines, checkpoint, closed_chunk.timestamps[-1] if len(closed_chunk) else None, aggregator.emitted_bucket
+
+
+# How the results of several migrate_table() runs of one table are combined. Anything not summed keeps its latest
+# value, except max_batch_points which keeps the largest.
+SUMMED_RESULT_KEYS = ['points', 'batches', 'bytes_raw', 'bytes_sent', 'retries', 'seconds', 'fetch_seconds',
+                      'transform_seconds', 'write_seconds', 'late_rows']
+
+
+def get_empty_result():
+    """ Result of a migrate_table() run that wrote nothing. """
+    
+    result = dict.fromkeys(SUMMED_RESULT_KEYS, 0)
+    result.update(dict.fromkeys(['seconds', 'fetch_seconds', 'transform_seconds', 'write_seconds'], 0.0))
+    result.update({'max_batch_points': 0, 'checkpoint': None, 'checkpoint_lag_seconds': None,
+                   'spool_pending_bytes': None, 'last_page_full': False})
+    
+    return result
+
+
+def merge_results(total: dict, result: dict):
+    """ Add the result of one migrate_table() run to the running total of its table. """
+    
+    for key in SUMMED_RESULT_KEYS:
+        
+        total[key] += result[key]
+    
+    total['max_batch_points'] = max(total['max_batch_points'], result['max_batch_points'])
+    
+    for key in ['checkpoint', 'checkpoint_lag_seconds', 'spool_pending_bytes']:
+        
+        if result[key] is not None:
+            
+            total[key] = result[key]
+
+
+def migrate_table(table: dict, config: dict, mysql_pool: MySQLConnectionPool, checkpoint_store: CheckpointStore,
+                  stop_event: threading.Event = None, upper_bound: int = None, spool_name: str = None):
+    """ Migrate all new rows of one table and return what was written and how long each stage took.
+    
+    Once stop_event is set no new chunks are fetched, but chunks already in the pipeline are still written. """
+    
+    start_time = time.monotonic()
+    
+    table_name = table['table_name']
+    chunk_size = config['chunk_size']
+    
+    last_state_value = checkpoint_store.get(table_name)
+    
+    # Kept next to the checkpoint of an aggregated table, see ChunkAggregator.
+    emitted_bucket_key = table_name + ':emitted_bucket'
+    last_emitted_bucket = checkpoint_store.get(emitted_bucket_key, None)
+    
+    influxdb_writer = get_influxdb_writer(config)
+    retries_before = influxdb_writer.retries
     
-    handler.write(content)
+    # Each stage only updates its own key, so the fetch and encode threads can share this dict without a lock.
+    result = get_empty_result()
     
-    handler.close()
+    spool = None
+    if config['spool_directory']:
+        
+        spool = WriteSpool(config['spool_directory'], spool_name or table_name, config['spool_max_bytes'])
+        
+        # Batches left over from a previous run or an InfluxDB outage go out before anything new.
+        influxdb_writer.drain(spool)
+    
+    # An aggregated table always catches up. Its checkpoint stays before the open buckets, so a single page that
+    # closes none of them would be read again on every run.
+    chunks = get_chunks_from_mysql(mysql_pool=mysql_pool, table=table, last_state_value=last_state_value,
+                                   chunk_size=chunk_size, catch_up=config['catch_up'] or bool(table.get('aggregate')),
+                                   stop_event=stop_event, upper_bound=upper_bound, metrics=result)
+    
+    # Fetch, encode and write run in their own threads, so MySQL reads the next chunk while the previous one is
+    # encoded and an earlier one is posted. The bounded queues between them cap how many chunks are in memory.
+    if config['pipeline']:
+        
+        chunks = prefetch(chunks, config['pipeline_queue_size'])
+    
+    if table.get('aggregate'):
+        
+        aggregator = ChunkAggregator(table, last_emitted_bucket)
+        encode_chunk = get_line_protocol_encoder(aggregator.output_table, config['influxdb_precision'])
+        batches = get_aggregated_batches(chunks, aggregator, encode_chunk, result)
+    else:
+        
+        encode_chunk = get_line_protocol_encoder(table, config['influxdb_precision'])
+        batches = get_encoded_batches(chunks, encode_chunk, result)
+    
+    if config['pipeline']:
+        
+        batches = prefetch(batches, config['pipeline_queue_size'])
+    
+    try:
+        for lines, max_auto_increment_value, max_timestamp, emitted_bucket in batches:
+            
+            # An aggregated chunk that closed no bucket has nothing to write, and may not move the checkpoint either.
+            if lines:
+                
+                write_start_time = time.perf_counter()
+                bytes_raw, bytes_sent = influxdb_writer.write(lines, spool)
+                result['write_seconds'] += time.perf_counter() - write_start_time
+                
+                result['points'] += len(lines)
+                result['batches'] += 1
+                result['max_batch_points'] = max(result['max_batch_points'], len(lines))
+                result['bytes_raw'] += bytes_raw
+                result['bytes_sent'] += bytes_sent
+                result['checkpoint_lag_seconds'] = time.time() - max_timestamp
+                
+                print('Written ' + str(len(lines)) + ' points for table ' + table_name + '.')
+            
+            if max_auto_increment_value != last_state_value or emitted_bucket != last_emitted_bucket:
+                
+                if emitted_bucket is None:
+                    
+                    checkpoint_store.set(table_name, max_auto_increment_value)
+                else:
+                    
+                    checkpoint_store.update({table_name: max_auto_increment_value, emitted_bucket_key: emitted_bucket})
+                
+                last_state_value = max_auto_increment_value
+                last_emitted_bucket = emitted_bucket
+                result['checkpoint'] = max_auto_increment_value
+    finally:
+        
+        # A failed write leaves the pipeline half consumed. Closing it stops the prefetch threads and gives their
+        # pooled MySQL connection back, instead of leaving both to the garbage collector.
+        batches.close()
+        chunks.close()
+        
+        if spool is not None:
+            
+            result['spool_pending_bytes'] = spool.get_pending_bytes()
+            spool.close()
+    
+    result['retries'] = influxdb_writer.retries - retries_before
+    result['seconds'] = time.monotonic() - start_time
+    
+    return result
+
+
+def migrate_tables(config: dict, mysql_pool: MySQLConnectionPool, checkpoint_store: CheckpointStore):
+    """ Migrate every table once, concurrently, and return the results per table. """
+    
+    results = {}
+    with ThreadPoolExecutor(max_workers=config['workers']) as executor:
+        
+        futures = {}
+        for table in config['tables']:
+            
+            futures[table['table_name']] = executor.submit(migrate_table, table, config, mysql_pool, checkpoint_store)
+        
+        for table_name, future in futures.items():
+            
+            try:
+                results[table_name] = future.result()
+            except Exception as e:
+                print('Exception migrating table %s: %s' % (table_name, str(e)))
+    
+    return results
+
+
+def get_next_poll_interval(config: dict, poll_interval: float, points: int, last_page_full: bool):
+    """ Poll again right away if the last page read was full, soon after one that found new data, and back off
+    while a table is idle. """
+    
+    if last_page_full:
+        
+        return 0
+    
+    if points > 0:
+        
+        return config['daemon_min_poll_interval']
+    
+    return min(max(poll_interval * 2, config['daemon_min_poll_interval']), config['daemon_max_poll_interval'])
+
+
+def tail_tables(config: dict, mysql_pool: MySQLConnectionPool, checkpoint_store: CheckpointStore,
+                stop_event: threading.Event):
+    """ Keep migrating every table with adaptive polling until stop_event is set, and return the totals per table. """
+    
+    results = {}
+    poll_intervals = {}
+    next_polls = {}
+    for table in config['tables']:
+        
+        results[table['table_name']] = get_empty_result()
+        poll_intervals[table['table_name']] = config['daemon_min_poll_interval']
+        next_polls[table['table_name']] = 0
+    
+    running = {}
+    with ThreadPoolExecutor(max_workers=config['workers']) as executor:
+        
+        while not stop_event.is_set():
+            
+            for table in config['tables']:
+                
+                table_name = table['table_name']
+                
+                if table_name not in running.values() and next_polls[table_name] <= time.monotonic():
+                    
+                    future = executor.submit(migrate_table, table, config, mysql_pool, checkpoint_store, stop_event)
+                    running[future] = table_name
+            
+            timeout = max(min(next_polls.values()) - time.monotonic(), 0.1)
+            
+            if running:
+                
+                done, _ = wait(running, timeout=min(timeout, 1), return_when=FIRST_COMPLETED)
+            else:
+                
+                stop_event.wait(min(timeout, 1))
+                done = []
+            
+            for future in done:
+                
+                table_name = running.pop(future)
+                points = 0
+                last_page_full = False
+                
+                try:
+                    result = future.result()
+                    points = result['points']
+                    last_page_full = result['last_page_full']
+                    
+                    merge_results(results[table_name], result)
+                    write_self_metrics(config, {table_name: result}, max_retries=0)
+                    write_prometheus_textfile(config, results)
+                
+                except Exception as e:
+                    print('Exception migrating table %s: %s' % (table_name, str(e)))
+                
+                poll_intervals[table_name] = get_next_poll_interval(config, poll_intervals[table_name], points,
+                                                                    last_page_full)
+                next_polls[table_name] = time.monotonic() + poll_intervals[table_name]
+        
+        print('Stopping, waiting for in-flight batches of %s tables.' % len(running))
+    
+    # The executor has waited for the tables that were still running at stop, so their results are in the totals too.
+    for future, table_name in running.items():
+        
+        try:
+            result = future.result()
+            
+            merge_results(results[table_name], result)
+            write_self_metrics(config, {table_name: result}, max_retries=0)
+        
+        except Exception as e:
+            print('Exception migrating table %s: %s' % (table_name, str(e)))
+    
+    if running:
+        
+        write_prometheus_textfile(config, results)
+    
+    return results
+
+
+def get_backfill_shards(config: dict, table: dict, mysql_pool: MySQLConnectionPool, last_state_value: int,
+                        shard_count: int):
+    """ Split the auto increment range after last_state_value into contiguous (lower, upper] shards. """
+    
+    auto_increment_column = table['auto_increment_column']
+    
+    with mysql_pool.connection() as connection:
+        
+        cursor = connection.cursor()
+        cursor.execute('SELECT MIN(' + auto_increment_column + '), MAX(' + auto_increment_column + ') FROM ' +
+                       table['table_name'] + ' WHERE ' + auto_increment_column + ' > %s', (last_state_value,))
+        min_value, max_value = cursor.fetchone()
+        cursor.close()
+    
+    if max_value is None:
+        
+        return []
+    
+    lower_bound = max(last_state_value, min_value - 1)
+    shard_width = -(-(max_value - lower_bound) // shard_count)
+    
+    shards = []
+    while lower_bound < max_value:
+        
+        shards.append([lower_bound, min(lower_bound + shard_width, max_value)])
+        lower_bound += shard_width
+    
+    return shards
 
 
-def get_data_from_mysql(host: str, username: str, password: str, db: str, sql: str):
-    """ Run SQL query and get data from MySQL table. """
+def get_shard_checkpoint_file(config: dict, table_name: str, shard_index: int):
+    """ Path of the checkpoint file of one backfill shard. """
     
-    db = MySQLdb.connect(host, username, password, db)
+    return '%s.backfill_%s_%s' % (config['checkpoint_file'], table_name, shard_index)
+
+
+def backfill_shard(table: dict, config: dict, shard_index: int, lower_bound: int, upper_bound: int):
+    """ Migrate one (lower, upper] shard of a table in a worker process, resuming from its own checkpoint. """
+    
+    checkpoint_store = CheckpointStore(get_shard_checkpoint_file(config, table['table_name'], shard_index))
+    
+    if checkpoint_store.get(table['table_name'], None) is None:
+        
+        checkpoint_store.set(table['table_name'], lower_bound)
     
-    cursor = db.cursor(MySQLdb.cursors.DictCursor)
+    mysql_pool = MySQLConnectionPool(host=config['mysql_host'], username=config['mysql_username'],
+                                     password=config['mysql_password'], db=config['mysql_database'], size=1,
+                                     port=config['mysql_port'])
     
     try:
-        cursor.execute(sql)
-        data = cursor.fetchall()
-    except Exception as e:
-        print("MySQL error %s: %s" % (e.args[0], e.args[1]))
-        data = None
+        return migrate_table(table, dict(config, catch_up=True), mysql_pool, checkpoint_store,
+                             upper_bound=upper_bound, spool_name='%s.backfill_%s' % (table['table_name'], shard_index))
+    finally:
+        mysql_pool.close()
+        get_influxdb_writer(config).close()
+
+
+def backfill_tables(config: dict, mysql_pool: MySQLConnectionPool, checkpoint_store: CheckpointStore,
+                    shard_count: int):
+    """ Backfill every table in parallel shards, then hand each table over to its incremental checkpoint. """
+    
+    results = {}
+    with ProcessPoolExecutor(max_workers=config['backfill_processes']) as executor:
+        
+        for table in config['tables']:
+            
+            table_name = table['table_name']
+            backfill_key = table_name + ':backfill'
+            
+            # The shard plan is kept in the main checkpoint file, so a resumed backfill reuses the same shards.
+            shards = checkpoint_store.get(backfill_key, None)
+            
+            if shards is None:
+                
+                # Aggregation buckets would be split between shards, so aggregated tables are backfilled in one.
+                shards = get_backfill_shards(config, table, mysql_pool, checkpoint_store.get(table_name),
+                                             1 if table.get('aggregate') else shard_count)
+                checkpoint_store.set(backfill_key, shards)
+            
+            print('Backfilling table %s in %s shards: %s.' % (table_name, len(shards), str(shards)))
+            
+            start_time = time.monotonic()
+            
+            futures = []
+            for shard_index, (lower_bound, upper_bound) in enumerate(shards):
+                
+                futures.append(executor.submit(backfill_shard, table, config, shard_index, lower_bound, upper_bound))
+            
+            result = get_empty_result()
+            failed = False
+            for shard_index, future in enumerate(futures):
+                
+                try:
+                    shard_result = future.result()
+                    merge_results(result, shard_result)
+                
+                except Exception as e:
+                    print('Exception backfilling shard %s of table %s: %s' % (shard_index, table_name, str(e)))
+                    failed = True
+                    continue
+                
+                # Only the shard drains its own spool, so batches still in it must not be handed over and forgotten.
+                if shard_result['spool_pending_bytes']:
+                    
+                    print('XXX Shard %s of table %s has %s bytes left in its spool.' % (
+                        shard_index, table_name, shard_result['spool_pending_bytes']))
+                    failed = True
+            
+            # Shards overlap in time, so throughput is reported against wall time rather than summed shard time.
+            result['seconds'] = time.monotonic() - start_time
+            results[table_name] = result
+            
+            if failed:
+                
+                print('Backfill of table %s is incomplete, run it again to resume.' % table_name)
+                continue
+            
+            # The last shard's checkpoint is the top of the range, or for an aggregated table the row before its
+            # newest open bucket.
+            if shards:
+                
+                last_shard_store = CheckpointStore(get_shard_checkpoint_file(config, table_name, len(shards) - 1))
+                checkpoint_store.update(dict([(key, value) for key, value in last_shard_store.checkpoints.items()
+                                              if key in [table_name, table_name + ':emitted_bucket']]))
+            checkpoint_store.delete(backfill_key)
+            
+            for shard_index in range(len(shards)):
+                
+                os.remove(get_shard_checkpoint_file(config, table_name, shard_index))
+                
+                # Every shard spool was drained, only the batches InfluxDB rejected are kept.
+                if config['spool_directory']:
+                    
+                    spool_path = os.path.join(config['spool_directory'], '%s.backfill_%s.spool' % (table_name,
+                                                                                                    shard_index))
+                    
+                    for path in [spool_path, spool_path + '.offset']:
+                        
+                        if os.path.exists(path):
+                            
+                            os.remove(path)
+            
+            result['checkpoint'] = checkpoint_store.get(table_name)
+            
+            print('Backfill of table %s complete, incremental checkpoint is now %s.' % (
+                table_name, result['checkpoint']))
+    
+    return results
+
+
+BINLOG_CHECKPOINT_KEY = '__binlog__'
+
+
+def get_binlog_row_builder(table: dict):
+    """ Function turning the column values of a binlog row event into a row in get_select_sql() column order.
+    
+    The binlog carries every column of the row, so tables without an auto increment column work too. """
+    
+    column_names = [table['unix_timestamp_column'], table.get('auto_increment_column')]
+    column_names += [item['column_name'] for item in table['columns']]
+    
+    def build_row(values: dict):
+        
+        return tuple([values.get(column_name) for column_name in column_names])
+    
+    return build_row
+
+
+def replicate_binlog(config: dict, checkpoint_store: CheckpointStore, stop_event: threading.Event):
+    """ Stream inserted and updated rows of every table from the MySQL row-based binlog until stop_event is set.
+    
+    Rows are only written once their transaction has committed, and the checkpoint is the binlog file and position
+    right after the last committed transaction that was written. Deletes are ignored. """
+    
+    # Only this mode needs python-mysql-replication, so the other modes keep working without it.
+    from pymysqlreplication import BinLogStreamReader
+    from pymysqlreplication.event import HeartbeatLogEvent, QueryEvent, XidEvent
+    from pymysqlreplication.row_event import UpdateRowsEvent, WriteRowsEvent
+    
+    tables = {}
+    build_rows = {}
+    encode_chunks = {}
+    for table in config['tables']:
+        
+        # Closing a bucket depends on the auto increment order of the rows, which the binlog does not follow.
+        if table.get('aggregate'):
+            
+            raise ValueError('Table %s is aggregated, which binlog replication does not support.' %
+                             table['table_name'])
+        
+        tables[table['table_name']] = table
+        build_rows[table['table_name']] = get_binlog_row_builder(table)
+        encode_chunks[table['table_name']] = get_line_protocol_encoder(table, config['influxdb_precision'])
+    
+    position = checkpoint_store.get(BINLOG_CHECKPOINT_KEY, None) or {}
+    
+    # Without a checkpoint the stream starts at the current end of the binlog. Run a one-shot migration first to
+    # copy what is already in the tables.
+    stream = BinLogStreamReader(connection_settings={'host'  : config['mysql_host'],
+                                                     'port'  : config['mysql_port'],
+                                                     'user'  : config['mysql_username'],
+                                                     'passwd': config['mysql_password']},
+                                server_id=config['binlog_server_id'],
+                                only_schemas=[config['mysql_database']],
+                                only_tables=list(build_rows),
+                                only_events=[WriteRowsEvent, UpdateRowsEvent, XidEvent, QueryEvent,
+                                             HeartbeatLogEvent],
+                                log_file=position.get('log_file'),
+                                log_pos=position.get('log_pos'),
+                                resume_stream=True,
+                                blocking=True,
+                                slave_heartbeat=config['binlog_flush_seconds'])
+    
+    influxdb_writer = get_influxdb_writer(config)
+    
+    results = {}
+    spools = {}
+    transaction_lines = {}
+    committed_lines = {}
+    for table_name in build_rows:
+        
+        results[table_name] = get_empty_result()
+        spools[table_name] = None
+        transaction_lines[table_name] = []
+        committed_lines[table_name] = []
+        
+        if config['spool_directory']:
+            
+            spools[table_name] = WriteSpool(config['spool_directory'], table_name, config['spool_max_bytes'])
+            influxdb_writer.drain(spools[table_name])
+    
+    committed = {'position': None, 'timestamp': None, 'flushed_at': time.monotonic()}
+    
+    def flush():
+        """ Write the rows of committed transactions and move the checkpoint past them. """
+        
+        written = {}
+        for flush_table_name, lines in committed_lines.items():
+            
+            if not lines:
+                
+                continue
+            
+            result = results[flush_table_name]
+            retries_before = influxdb_writer.retries
+            
+            write_start_time = time.perf_counter()
+            bytes_raw, bytes_sent = influxdb_writer.write(lines, spools[flush_table_name])
+            write_seconds = time.perf_counter() - write_start_time
+            
+            result['write_seconds'] += write_seconds
+            result['seconds'] += write_seconds
+            result['retries'] += influxdb_writer.retries - retries_before
+            result['points'] += len(lines)
+            result['batches'] += 1
+            result['max_batch_points'] = max(result['max_batch_points'], len(lines))
+            result['bytes_raw'] += bytes_raw
+            result['bytes_sent'] += bytes_sent
+            result['checkpoint_lag_seconds'] = time.time() - committed['timestamp']
+            
+            if spools[flush_table_name] is not None:
+                
+                result['spool_pending_bytes'] = spools[flush_table_name].get_pending_bytes()
+            
+            written[flush_table_name] = result
+            committed_lines[flush_table_name] = []
+            
+            print('Written ' + str(len(lines)) + ' points for table ' + flush_table_name + '.')
+        
+        if committed['position'] is not None:
+            
+            checkpoint_store.set(BINLOG_CHECKPOINT_KEY, committed['position'])
+            committed['position'] = None
+        
+        committed['flushed_at'] = time.monotonic()
+        
+        if written:
+            
+            write_self_metrics(config, written, max_retries=0)
+            write_prometheus_textfile(config, results)
+    
+    try:
+        for event in stream:
+            
+            if isinstance(event, (WriteRowsEvent, UpdateRowsEvent)):
+                
+                build_row = build_rows[event.table]
+                
+                transform_start_time = time.perf_counter()
+                
+                chunk = ColumnChunk(tables[event.table]['columns'])
+                for row in event.rows:
+                    
+                    chunk.append(build_row(row['values'] if 'values' in row else row['after_values']))
+                
+                transaction_lines[event.table].extend(encode_chunks[event.table](chunk))
+                
+                results[event.table]['transform_seconds'] += time.perf_counter() - transform_start_time
+            
+            # Transactional tables end a transaction with an XID event, others with a COMMIT query.
+            elif isinstance(event, XidEvent) or (isinstance(event, QueryEvent) and event.query == 'COMMIT'):
+                
+                for table_name, lines in transaction_lines.items():
+                    
+                    committed_lines[table_name].extend(lines)
+                    transaction_lines[table_name] = []
+                
+                committed['position'] = {'log_file': stream.log_file, 'log_pos': stream.log_pos}
+                committed['timestamp'] = event.timestamp
+            
+            pending_points = sum([len(lines) for lines in committed_lines.values()])
+            
+            if pending_points >= config['chunk_size'] or \
+                    time.monotonic() - committed['flushed_at'] >= config['binlog_flush_seconds']:
+                
+                flush()
+            
+            if stop_event.is_set():
+                
+                break
+    finally:
+        
+        print('Stopping, writing rows of committed transactions.')
+        
+        try:
+            flush()
+        finally:
+            
+            stream.close()
+            
+            for spool in spools.values():
+                
+                if spool is not None:
+                    
+                    spool.close()
+    
+    return results
+
+
+def print_results(results: dict):
+    """ Print points, throughput, time per stage and bytes sent per table. """
+    
+    for table_name, result in results.items():
+        
+        if result['points'] == 0:
+            
+            print('No data retrieved from MySQL for table ' + table_name + '.')
+            continue
+        
+        print('%s: %s points in %s batches in %.2f seconds (%.0f points/sec), fetch %.2fs, transform %.2fs, '
+              'write %.2fs, %s retries, %s bytes sent (compression ratio %.1f), checkpoint %s, lag %.0fs.' % (
+                  table_name, result['points'], result['batches'], result['seconds'],
+                  result['points'] / result['seconds'] if result['seconds'] else 0, result['fetch_seconds'],
+                  result['transform_seconds'], result['write_seconds'], result['retries'], result['bytes_sent'],
+                  result['bytes_raw'] / result['bytes_sent'] if result['bytes_sent'] else 0, result['checkpoint'],
+                  result['checkpoint_lag_seconds']))
+
+
+# Self-monitoring fields written as floats. The rest are integers. A field keeps one type in InfluxDB, so the type
+# comes from the key rather than from the type a value happens to have.
+SELF_METRIC_FLOAT_KEYS = ['seconds', 'fetch_seconds', 'transform_seconds', 'write_seconds', 'checkpoint_lag_seconds',
+                          'points_per_second', 'mean_batch_points']
+
+
+def get_self_metrics(result: dict):
+    """ Self-monitoring metric values of one table, derived from a migrate_table() result. """
+    
+    metrics = dict(result)
+    metrics.pop('last_page_full', None)
+    metrics['points_per_second'] = result['points'] / result['seconds'] if result['seconds'] else 0.0
+    metrics['mean_batch_points'] = result['points'] / result['batches'] if result['batches'] else 0.0
+    
+    return {key: value for key, value in metrics.items() if value is not None}
+
+
+def write_self_metrics(config: dict, results: dict, max_retries: int = None):
+    """ Write migrator metrics per table as points of the self-monitoring measurement, if one is configured.
+    
+    The long running modes write them without retries, so an InfluxDB outage does not hold up their next poll. The
+    metrics of a failed write are skipped, not retried later. """
+    
+    if not config['self_monitoring_measurement']:
+        
+        return
+    
+    measurement = config['self_monitoring_measurement'].translate(MEASUREMENT_ESCAPES)
+    timestamp = str(int(time.time() * TIME_PRECISION_MULTIPLIERS[config['influxdb_precision']]))
+    
+    lines = []
+    for table_name, result in results.items():
+        
+        fields = ','.join([key + '=' + FIELD_FORMATTERS['float' if key in SELF_METRIC_FLOAT_KEYS else 'int'](value)
+                           for key, value in sorted(get_self_metrics(result).items())])
+        
+        lines.append((measurement + ',table=' + table_name.translate(KEY_ESCAPES) + ' ' + fields + ' ' +
+                      timestamp).encode())
+    
+    try:
+        get_influxdb_writer(config).write(lines, max_retries=max_retries)
+    except InfluxDBWriteError as e:
+        print('Exception writing self-monitoring metrics: %s' % str(e))
+
+
+def write_prometheus_textfile(config: dict, results: dict):
+    """ Atomically replace the Prometheus text file with the metrics of every table, if one is configured. """
+    
+    if not config['prometheus_textfile']:
+        
+        return
+    
+    samples = {}
+    for table_name, result in results.items():
+        
+        for key, value in get_self_metrics(result).items():
+            
+            samples.setdefault(key, []).append('migrate_mysql_to_influxdb_%s{table="%s"} %s' % (
+                key, table_name.replace('\\', '\\\\').replace('"', '\\"'), value))
+    
+    content = ''
+    for key in sorted(samples):
+        
+        content += '# TYPE migrate_mysql_to_influxdb_%s gauge\n' % key
+        content += '\n'.join(samples[key]) + '\n'
     
-    db.close()
+    tmp_path = config['prometheus_textfile'] + '.tmp'
+    with open(tmp_path, 'w') as handler:
+        handler.write(content)
     
-    return data
+    os.replace(tmp_path, config['prometheus_textfile'])
 
 
 main_config = {
-    'state_file_path'  : '/tmp/migrate_mysql_to_influxdb_state_file_',
-    'mysql_host'       : 'localhost',
-    'mysql_username'   : 'username',
-    'mysql_password'   : 'password',
-    'mysql_database'   : 'db',
-    'influxdb_host'    : 'localhost',
-    'influxdb_port'    : '8086',
-    'influxdb_database': 'db',
-    'tables'           : [
+    'checkpoint_file'            : '/tmp/migrate_mysql_to_influxdb_checkpoints.json',
+    'state_file_path'            : '/tmp/migrate_mysql_to_influxdb_state_file_',
+    'mysql_host'                 : 'localhost',
+    'mysql_username'             : 'username',
+    'mysql_password'             : 'password',
+    'mysql_database'             : 'db',
+    'mysql_port'                 : 3306,
+    'influxdb_host'              : 'localhost',
+    'influxdb_port'              : '8086',
+    'influxdb_database'          : 'db',
+    'influxdb_precision'         : 's',
+    'influxdb_batch_bytes'       : 5000000,
+    'influxdb_batch_points'      : 5000,
+    'influxdb_gzip'              : True,
+    'influxdb_retries'           : 5,
+    'spool_directory'            : '/tmp/migrate_mysql_to_influxdb_spool',
+    'spool_max_bytes'            : 1000000000,
+    'chunk_size'                 : 10000,
+    'catch_up'                   : True,
+    'pipeline'                   : True,
+    'pipeline_queue_size'        : 2,
+    'workers'                    : 4,
+    'mysql_pool_size'            : 4,
+    'daemon_min_poll_interval'   : 1,
+    'daemon_max_poll_interval'   : 60,
+    'backfill_processes'         : 4,
+    'binlog_server_id'           : 4242,
+    'binlog_flush_seconds'       : 1,
+    'self_monitoring_measurement': 'migrate_mysql_to_influxdb',
+    'prometheus_textfile'        : None,
+    # A table can also roll its rows up before they are written, e.g.
+    # 'aggregate': {'bucket_seconds': 60, 'fields': {'column_2': 'mean'}, 'group_by': ['column_1']}
+    # with sum, mean, min, max, count or last per field. group_by defaults to every tag column.
+    'tables'                     : [
         {
             'table_name'           : 'table_1',
             'measurement_name'     : 'table_1',
@@ -97,92 +1858,55 @@ main_config = {
 
 if __name__ == '__main__':
     
-    mysql_tables = main_config['tables']
-    state_file_prefix = main_config['state_file_path']
+    parser = argparse.ArgumentParser()
     
-    for table in mysql_tables:
-        
-        table_name = table['table_name']
-        measurement = table['measurement_name']
-        state_file = state_file_prefix + table_name
-        
-        last_state_value = file_read(state_file) if file_read(state_file) else '0'
-        
-        columns_list = [table['unix_timestamp_column'], table['auto_increment_column']]
-        default_values = {}
-        tags_list = []
-        for item in table['columns']:
-            
-            columns_list.append(item['column_name'])
-            
-            if item['type'] == 'string':
-                
-                default_values[item['column_name']] = ''
-            if item['type'] == 'int':
-                
-                default_values[item['column_name']] = 0
-            if item['type'] == 'float':
-                
-                default_values[item['column_name']] = 0.0
-            
-            if item['is_tag']:
-                
-                tags_list.append(item['column_name'])
+    parser.add_argument('--daemon', action='store_true',
+                        help='Keep running and tail every table instead of migrating once and exiting.')
+    parser.add_argument('--backfill', action='store_true',
+                        help='Backfill every table in parallel shards, then hand over to the incremental checkpoint. '
+                             'Do not run incremental migrations while a backfill is in progress.')
+    parser.add_argument('--binlog', action='store_true',
+                        help='Keep running and replicate inserted and updated rows from the MySQL row-based binlog '
+                             'instead of polling the tables. Needs python-mysql-replication and binlog_format=ROW.')
+    parser.add_argument('--shards', type=int, default=8, help='Number of shards per table for --backfill.')
+    
+    args = parser.parse_args()
+    
+    checkpoint_store = CheckpointStore(main_config['checkpoint_file'], main_config['state_file_path'])
+    
+    mysql_pool = MySQLConnectionPool(host=main_config['mysql_host'], username=main_config['mysql_username'],
+                                     password=main_config['mysql_password'], db=main_config['mysql_database'],
+                                     size=main_config['mysql_pool_size'], port=main_config['mysql_port'])
+    
+    # Only the long running modes stop cleanly on a signal. The one-shot modes keep the default handlers, so Ctrl-C
+    # and SIGTERM still stop them and their backfill workers.
+    stop_event = threading.Event()
+    if args.daemon or args.binlog:
         
-        columns_list = ','.join(columns_list)
+        signal.signal(signal.SIGTERM, lambda signum, frame: stop_event.set())
+        signal.signal(signal.SIGINT, lambda signum, frame: stop_event.set())
+    
+    if args.daemon:
         
-        sql = 'SELECT ' + columns_list + ' FROM ' + table_name + ' WHERE ' + table[
-            'auto_increment_column'] + ' > ' + last_state_value + ' LIMIT 10000'
+        migration_results = tail_tables(main_config, mysql_pool, checkpoint_store, stop_event)
+    
+    elif args.binlog:
         
-        data = get_data_from_mysql(host=main_config['mysql_host'], username=main_config['mysql_username'],
-                                   password=main_config['mysql_password'], db=main_config['mysql_database'], sql=sql)
+        migration_results = replicate_binlog(main_config, checkpoint_store, stop_event)
+    
+    elif args.backfill:
         
-        influxdb_data = []
+        migration_results = backfill_tables(main_config, mysql_pool, checkpoint_store, args.shards)
+    else:
         
-        if len(data) > 0:
-            
-            influxdb_client = InfluxDBClient(main_config['influxdb_host'], main_config['influxdb_port'], '', '',
-                                             main_config['influxdb_database'])
-            
-            for item in data:
-                
-                timestamp = 0
-                fields = {}
-                tags = {}
-                max_auto_increment_value = 0
-                for key, value in item.items():
-                    
-                    if key == table['auto_increment_column']:
-                        
-                        max_auto_increment_value = value
-                    
-                    elif key == table['unix_timestamp_column']:
-                        
-                        timestamp = datetime.datetime.fromtimestamp(value).isoformat()
-                    else:
-                        
-                        if key in tags_list:
-                            
-                            tags[key] = value
-                        else:
-                            
-                            fields[key] = value if value else default_values[key]
-                
-                data_point = {
-                    "measurement": measurement,
-                    "tags"       : tags,
-                    "time"       : timestamp,
-                    "fields"     : fields
-                }
-                
-                influxdb_data.append(data_point)
-                
-                file_write(state_file, 'w', str(max_auto_increment_value))
-            
-            influxdb_client.write_points(influxdb_data)
-            
-            print('Written ' + str(len(data)) + ' points for table ' + table_name + '.')
+        migration_results = migrate_tables(main_config, mysql_pool, checkpoint_store)
+    
+    mysql_pool.close()
+    
+    # The daemon and binlog modes write their metrics as they go, so only the one-shot modes write them here.
+    if not args.daemon and not args.binlog:
         
-        else:
-            
-            print('No data retrieved from MySQL for table ' + table_name + '.')
+        write_self_metrics(main_config, migration_results)
+        write_prometheus_textfile(main_config, migration_results)
+    
+    print_results(migration_results)
\ No newline at end of file